@@ -24,26 +24,30 @@ class fibril_conformation():
 		return acc
 
 	def fit_axis(self,coord_all,idx):
-		# Get COM
+		axis,p = self.fit_axes(coord_all[None],idx)
+		return axis.reshape(1,3),p.reshape(1,3)
+
+	def fit_axes(self,traj,idx):
+		# Fit the axis of every frame at once by stacked least squares, t = position along each segment from its atom closest to the COM
 		idx_all = flatten_one_order(idx)
-		com = np.mean(coord_all[idx_all],axis=0).reshape((1,3))
-		# Get t
+		coord = traj[:,idx_all]
+		com = np.mean(coord,axis=1,keepdims=True)
 		acc_t = []
 		for idx_i in idx:
-			idx_c = np.argmin(np.linalg.norm(coord_all[idx_i]-com,axis=1))
-			t = np.array([i for i in range(len(idx_i))])-idx_c
-			acc_t += t.tolist()
-		# Get b
-		X = np.stack([np.ones(len(acc_t)),acc_t],axis=0).T
-		Y = coord_all[idx_all] 
-		b = np.dot(np.linalg.inv(np.dot(X.T,X)),np.dot(X.T,Y))
-		return b[1].reshape(1,3),b[0].reshape(1,3)
+			idx_c = np.argmin(np.linalg.norm(traj[:,idx_i]-com,axis=2),axis=1)
+			acc_t += [np.arange(len(idx_i))[None,:]-idx_c[:,None]]
+		t = np.concatenate(acc_t,axis=1).astype(float)
+		# Solve the 2 x 2 normal equations of X = [1, t] for all frames
+		n,st,stt = t.shape[1],np.sum(t,axis=1),np.sum(t**2,axis=1)
+		sy,sty = np.sum(coord,axis=1),np.einsum('fa,fai->fi',t,coord)
+		det = (n*stt-st**2)[:,None]
+		axis = (n*sty-st[:,None]*sy)/det
+		p = (stt[:,None]*sy-st[:,None]*sty)/det
+		return axis,p
 
 	def cal_radius(self,coord_all,p,axis):
-		cos = cal_cos(coord_all-p,axis)
-		sin = (1-cos**2)**0.5
-		dist = np.linalg.norm(coord_all-p,axis=1)*sin
-		return dist
+		# Distance of every atom to the axis through p
+		return np.linalg.norm(np.cross(coord_all-p,axis),axis=-1)/np.linalg.norm(axis,axis=-1)
 
 	def cal_pitch(self,coord_all,n,axis):
 		p1 = coord_all[n[:,0].tolist()]
@@ -55,18 +59,25 @@ class fibril_conformation():
 	def get_morph(self,traj):
 		idx = [[i for i in range(si[0],si[1]+1)] for si in self.s]
 		idx_all = flatten_one_order(idx)
-		n = np.array(self.get_neighbor_k(self.s,2))
-		lo_radius,lo_pitch = [],[]
-		for i in range(traj.shape[0]):
-			coord_all = traj[i]
-			axis,p = self.fit_axis(coord_all,idx)
-			print (axis,p)
-			# Radius
-			radius = self.cal_radius(coord_all[idx_all],p,axis)
-			lo_radius += [np.mean(radius,axis=0)]
-			# Pitch
-			lo_pitch += [np.linalg.norm(axis)]
-		return {'radius':np.array(lo_radius),'pitch':np.array(lo_pitch)}
+		axis,p = self.fit_axes(traj,idx)
+		# Radius
+		radius = self.cal_radius(traj[:,idx_all],p[:,None,:],axis[:,None,:])
+		# Pitch
+		return {'radius':np.mean(radius,axis=1),'pitch':np.linalg.norm(axis,axis=1)}
 
+	def get_atom_index(self):
+		# Atoms of the trajectory used by the analysis, and the ranges s renumbered within them
+		idx = [[i for i in range(si[0],si[1]+1)] for si in self.s]
+		offset = np.cumsum([0]+[len(idx_i) for idx_i in idx])
+		return flatten_one_order(idx),[[offset[i],offset[i+1]-1] for i in range(len(idx))]
 
+	def iter_morph(self,reader):
+		# Radius and pitch of every block of frames from a trajectory reader (see traj.py), reading only atoms in s
+		idx_all,s_local = self.get_atom_index()
+		local = fibril_conformation(s_local)
+		for block in reader.iter_blocks(idx_all):
+			yield local.get_morph(block)
 
+	def get_morph_series(self,reader):
+		acc = list(self.iter_morph(reader))
+		return {'radius':np.concatenate([m['radius'] for m in acc]),'pitch':np.concatenate([m['pitch'] for m in acc])}
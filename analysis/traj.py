@@ -0,0 +1,135 @@
+import os
+import numpy as np
+
+def open_trajectory(root,num_atoms=None,chunk=1000,fmt=None,box=None):
+	# Open a trajectory (.npy, .dcd, .nc, .mdcrd/.crd) for block-wise reading
+	if fmt == None:
+		fmt = os.path.splitext(root)[1].lower().lstrip('.')
+	if fmt == 'npy':
+		return npy_trajectory(root,chunk)
+	elif fmt == 'dcd':
+		return dcd_trajectory(root,chunk)
+	elif fmt in ['nc','netcdf','ncdf']:
+		return netcdf_trajectory(root,chunk)
+	elif fmt in ['mdcrd','crd','x']:
+		return mdcrd_trajectory(root,num_atoms,chunk,box)
+	else:
+		raise ValueError('Unknown trajectory format: '+str(fmt))
+
+class memmap_trajectory():
+	# Base class for trajectories held in a (frames, atoms, 3) array-like without loading it
+	def iter_blocks(self,idx):
+		# Yield (frames in block, atoms in idx, 3) arrays of at most self.chunk frames
+		idx = np.array(idx)
+		for i in range(0,self.num_frames,self.chunk):
+			yield np.array(self.get_frames(i,min(i+self.chunk,self.num_frames),idx),dtype=float)
+
+class npy_trajectory(memmap_trajectory):
+	# INPUT (.npy file of shape (frames, atoms, 3), frames per block)
+	def __init__(self,root,chunk):
+		self.coords = np.load(root,mmap_mode='r')
+		self.num_frames,self.num_atoms = self.coords.shape[:2]
+		self.chunk = chunk
+
+	def get_frames(self,start,end,idx):
+		return self.coords[start:end][:,idx]
+
+class dcd_trajectory(memmap_trajectory):
+	# INPUT (CHARMM/NAMD .dcd file, frames per block)
+	def __init__(self,root,chunk):
+		self.chunk = chunk
+		with open(root,'rb') as f:
+			head = f.read(92)
+			endian = '<' if np.frombuffer(head[:4],'<i4')[0] == 84 else '>'
+			if np.frombuffer(head[:4],endian+'i4')[0] != 84 or head[4:8] != b'CORD':
+				raise ValueError('Not a DCD file: '+root)
+			icntrl = np.frombuffer(head[8:88],endian+'i4')
+			if icntrl[8] != 0:
+				raise ValueError('DCD files with fixed atoms are not supported')
+			has_cell = (icntrl[19] != 0) and (icntrl[10] != 0)
+			# Skip the title record and read the number of atoms
+			size = np.frombuffer(f.read(4),endian+'i4')[0]
+			f.seek(size+4,1)
+			f.read(4)
+			self.num_atoms = int(np.frombuffer(f.read(4),endian+'i4')[0])
+			f.read(4)
+			offset = f.tell()
+		fields = []
+		if has_cell:
+			fields += [('cell0',endian+'i4'),('cell',endian+'f8',6),('cell1',endian+'i4')]
+		for ax in 'xyz':
+			fields += [(ax+'0',endian+'i4'),(ax,endian+'f4',self.num_atoms),(ax+'1',endian+'i4')]
+		dtype = np.dtype(fields)
+		self.num_frames = (os.path.getsize(root)-offset)//dtype.itemsize
+		self.frames = np.memmap(root,dtype=dtype,mode='r',offset=offset,shape=(self.num_frames,))
+
+	def get_frames(self,start,end,idx):
+		frames = self.frames[start:end]
+		return np.stack([frames['x'][:,idx],frames['y'][:,idx],frames['z'][:,idx]],axis=2)
+
+class netcdf_trajectory(memmap_trajectory):
+	# INPUT (Amber NetCDF trajectory, frames per block), memory-mapped with scipy
+	def __init__(self,root,chunk):
+		try:
+			from scipy.io import netcdf_file
+		except ImportError:
+			raise ImportError('Reading Amber NetCDF trajectories requires scipy')
+		self.f = netcdf_file(root,'r',mmap=True)
+		self.coords = self.f.variables['coordinates']
+		self.num_frames,self.num_atoms = self.coords.shape[:2]
+		self.chunk = chunk
+
+	def get_frames(self,start,end,idx):
+		return self.coords[start:end][:,idx]
+
+class mdcrd_trajectory():
+	# INPUT (Amber ASCII trajectory, number of atoms, frames per block, whether frames end with a box line)
+	def __init__(self,root,num_atoms,chunk,box=None):
+		if num_atoms == None:
+			raise ValueError('The number of atoms is required to read an mdcrd trajectory')
+		self.root = root
+		self.num_atoms = num_atoms
+		self.chunk = chunk
+		self.num_lines = int(np.ceil(3*num_atoms/10.0))
+		if box == None:
+			box = self.has_box()
+		self.box = box
+
+	def has_box(self):
+		# Whether every frame ends with a box line, from the number of lines after the title (whole frames with or without box lines)
+		with open(self.root,'rb') as f:
+			num,last = 0,b'\n'
+			for block in iter(lambda:f.read(2**20),b''):
+				num += block.count(b'\n')
+				last = block[-1:]
+		num += int(last != b'\n')-1
+		fit = [(num > 0) and (num%(self.num_lines+k) == 0) for k in (0,1)]
+		if fit[0] != fit[1]:
+			return fit[1]
+		# Both (or neither) fit: the line after the first frame is a box line (3 values) or starts the next frame (up to 10 values)
+		with open(self.root) as f:
+			lines = [f.readline().rstrip('\r\n') for i in range(2*self.num_lines+3)]
+		if self.num_atoms > 1:
+			return 0 < len(lines[self.num_lines+1]) <= 24
+		# A single atom gives frame lines of 3 values too, then a box line repeats the previous one
+		return (lines[2] != '') and (lines[2] == lines[4])
+
+	def iter_blocks(self,idx):
+		idx = np.array(idx)
+		lines_per_frame = self.num_lines+int(self.box)
+		with open(self.root) as f:
+			f.readline()
+			while True:
+				acc = []
+				for i in range(self.chunk):
+					lines = [f.readline() for k in range(lines_per_frame)]
+					if not lines[-1]:
+						break
+					acc += [''.join([line.rstrip('\r\n') for line in lines[:self.num_lines]])]
+				if len(acc) == 0:
+					return
+				# Fixed-width (8 characters) values
+				values = np.frombuffer(''.join(acc).encode(),dtype='S8').astype(float)
+				yield values.reshape((len(acc),self.num_atoms,3))[:,idx]
+				if len(acc) < self.chunk:
+					return
@@ -0,0 +1,107 @@
+# Compact archive of fibril models: the template atoms once, per-copy rigid transforms and the refined parameters of every candidate
+
+import json
+import zipfile
+import numpy as np
+from engine import PEP_NAMES,atom_template
+from model import TRANSFORM_KEYS,fibril_model
+
+# Refined parameters of a candidate (see create_fibril.set_dimension)
+PARAM_KEYS = ['radius','angle_z','angle_y','pitch','period']
+# Atom fields of a template peptide
+ATOM_KEYS = ['coords','name','resn','resi','chain','elem']
+
+def save_archive(root_out,models,info=None):
+	# Write one or many models of the same unit (e.g. all candidates of a screen) to an uncompressed .npz, with optional JSON-able info per model
+	if isinstance(models,fibril_model):
+		models = [models]
+	templates,acc,lo_param,lo_info = None,{},[],[]
+	for (i,model) in enumerate(models):
+		if templates == None:
+			templates = model.templates
+		elif any([not np.array_equal(templates[pep].coords,model.templates[pep].coords) for pep in PEP_NAMES]):
+			raise ValueError('All models of an archive must share one unit')
+		if len(model.transforms) != len(TRANSFORM_KEYS):
+			raise ValueError('Only models with copy transforms can be archived')
+		for (key,value) in [('pep',model.pep),('layer',model.layer),('stack',model.stack)]+[(key,model.transforms[key]) for key in TRANSFORM_KEYS]:
+			acc.setdefault(key,[]).append(value)
+		lo_param += [[model.dimension.get(key,np.nan) for key in PARAM_KEYS]]
+		lo_info += [json.dumps(info[i] if info != None else {})]
+	if templates == None:
+		raise ValueError('No model to archive')
+	arrays = {}
+	# Templates, concatenated in the order of PEP_NAMES
+	for key in ATOM_KEYS:
+		arrays['atom_'+key] = np.concatenate([getattr(templates[pep],key) for pep in PEP_NAMES])
+	arrays['template_start'] = np.r_[0,np.cumsum([len(templates[pep]) for pep in PEP_NAMES])]
+	# Copies of all candidates, concatenated
+	num_copies = [len(pep) for pep in acc['pep']]
+	arrays['copy_start'] = np.r_[0,np.cumsum(num_copies)]
+	for key in ['pep','layer','stack']:
+		arrays['copy_'+key] = np.concatenate(acc[key]).astype(np.int32)
+	for key in TRANSFORM_KEYS:
+		arrays['copy_'+key] = np.concatenate(acc[key]).astype(float)
+	arrays['param'] = np.array(lo_param,dtype=float).reshape((-1,len(PARAM_KEYS)))
+	arrays['info'] = np.array(lo_info,dtype=str)
+	if not root_out.endswith('.npz'):
+		root_out += '.npz'
+	np.savez(root_out,**arrays)
+	return root_out
+
+def load_arrays(root,mmap=1):
+	# Arrays of an .npz, memory-mapped where the member is stored without compression
+	arrays = {}
+	with zipfile.ZipFile(root) as z, open(root,'rb') as f:
+		for info in z.infolist():
+			key = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+			if (not mmap) or (info.compress_type != zipfile.ZIP_STORED):
+				with z.open(info) as member:
+					arrays[key] = np.lib.format.read_array(member)
+				continue
+			# The data starts after the local file header and the .npy header
+			f.seek(info.header_offset+26)
+			len_name,len_extra = np.frombuffer(f.read(4),'<u2')
+			f.seek(info.header_offset+30+int(len_name)+int(len_extra))
+			version = np.lib.format.read_magic(f)
+			read_header = np.lib.format.read_array_header_1_0 if version == (1,0) else np.lib.format.read_array_header_2_0
+			shape,fortran_order,dtype = read_header(f)
+			if dtype.hasobject:
+				raise ValueError('Object arrays cannot be memory-mapped: '+key)
+			if np.prod(shape) == 0:
+				arrays[key] = np.zeros(shape,dtype=dtype)
+			else:
+				arrays[key] = np.memmap(root,dtype=dtype,mode='r',offset=f.tell(),shape=shape,order='F' if fortran_order else 'C')
+	return arrays
+
+class fibril_library():
+	# INPUT (archive written by save_archive, memory-map the arrays)
+	def __init__(self,root,mmap=1):
+		self.root = root
+		self.arrays = load_arrays(root,mmap)
+		start = self.arrays['template_start']
+		self.templates = {}
+		for (p,pep) in enumerate(PEP_NAMES):
+			self.templates[pep] = atom_template(*[np.array(self.arrays['atom_'+key][start[p]:start[p+1]]) for key in ATOM_KEYS])
+		self.params = self.arrays['param']
+
+	def __len__(self):
+		return len(self.params)
+
+	def get_params(self,i):
+		return dict(zip(PARAM_KEYS,self.params[i].tolist()))
+
+	def get_info(self,i):
+		return json.loads(str(self.arrays['info'][i]))
+
+	def get_model(self,i):
+		# Candidate i as a fibril_model; only its copies are read, and its coordinates are computed on the first get_coords
+		a,b = self.arrays['copy_start'][i],self.arrays['copy_start'][i+1]
+		table = dict([(key,np.array(self.arrays['copy_'+key][a:b])) for key in ['pep','layer','stack']+TRANSFORM_KEYS])
+		return fibril_model(self.templates,table,None,self.get_params(i))
+
+	def iter_models(self):
+		for i in range(len(self)):
+			yield self.get_model(i)
+
+def open_archive(root,mmap=1):
+	return fibril_library(root,mmap)
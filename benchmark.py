@@ -0,0 +1,227 @@
+# python benchmark.py -h
+
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Bundled bilayers: (PDB, residue ranges of the four peptides, reference atoms as resi/name)
+BENCH_UNITS = {'capF8':('structures/input/capF8_bilayer.pdb',['21-30','31-40','111-120','121-130'],['22/CA','29/CA','62/CA']),\
+				'HP8':('structures/input/HP8_bilayer.pdb',['21-30','31-40','111-120','121-130'],['22/CA','29/CA','62/CA']),\
+				'AL1':('structures/input/AL1_bilayer.pdb',['25-36','37-48','133-144','145-156'],['26/CA','35/CA','74/CA'])}
+# The example() builds as (build method, arguments), with num_half given as None
+BENCH_MORPHOLOGY = {'a_sheet':('build_a_flat_sheet',[None]),\
+					's_sheet':('build_a_stacked_sheet',[[[0,1],[1,1]],None]),\
+					'a_rod':('build_a_rod',[20,None,1]),\
+					's_rod':('build_a_stacked_rod',[10,[[0,1],[1,1]],None,1]),\
+					'a_ribbon':('build_a_ribbon',[10,30,None,-1]),\
+					's_ribbon':('build_a_stacked_ribbon',[10,30,70,2,None,1])}
+BENCH_HALF = {'a_sheet':5,'s_sheet':5,'a_rod':25,'s_rod':15,'a_ribbon':60,'s_ribbon':20}
+# Scaled versions of the examples
+SCALE_HALF = [5,50,500]
+SCALE_STACKING = [2,3,4,6,10]
+SCALE_STACK = [2,4,8]
+# Methods whose calls are counted, and those whose time is summed
+COUNT_METHODS = ['check_unit','unit_is_not_clashed']
+TIME_METHODS = {'refine':['refine_theta','refine_theta_radius','refine_stack_rod','refine_stack_ribbon'],'emit':['emit']}
+
+def get_case(unit,morphology,num_half=None,stacking=None,num_stack=None):
+	# One build: the example of a morphology with num_half, the stacking matrix or num_stack replaced
+	method,args = BENCH_MORPHOLOGY[morphology]
+	name = unit+'/'+morphology
+	if num_half != None:
+		name += '/n'+str(num_half)
+	else:
+		num_half = BENCH_HALF[morphology]
+	args = [num_half if a == None else a for a in args]
+	if stacking != None:
+		args[1 if morphology == 's_rod' else 0] = np.ones((stacking,stacking),dtype=int).tolist()
+		name += '/k'+str(stacking)+'x'+str(stacking)
+	if num_stack != None:
+		# The stacking angle of the example, or a full turn shared by all stacks
+		args[2],args[3] = min(args[2],360//num_stack),num_stack
+		name += '/m'+str(num_stack)
+	return {'name':name,'unit':unit,'morphology':morphology,'method':method,'args':args}
+
+def get_cases(units=None):
+	# The six examples and their scaled versions for every bundled bilayer
+	acc = []
+	for unit in (units or sorted(BENCH_UNITS)):
+		for morphology in BENCH_MORPHOLOGY:
+			acc += [get_case(unit,morphology)]
+			acc += [get_case(unit,morphology,num_half=n) for n in SCALE_HALF if n != BENCH_HALF[morphology]]
+			if morphology in ['s_sheet','s_rod']:
+				acc += [get_case(unit,morphology,stacking=k) for k in SCALE_STACKING]
+			if morphology == 's_ribbon':
+				acc += [get_case(unit,morphology,num_stack=m) for m in SCALE_STACK if m != BENCH_MORPHOLOGY[morphology][1][3]]
+	return acc
+
+class call_counter():
+	# Count (and time) calls of wrapped functions until restore
+	def __init__(self):
+		self.counts = {}
+		self.times = {}
+		self.saved = []
+		self.depth = {}
+
+	def wrap(self,owner,name,key,outer=0):
+		# Replace owner.name; with outer, calls made from inside another call of the same key are not counted
+		func = getattr(owner,name)
+		self.saved += [(owner,name,owner.__dict__.get(name))]
+		self.counts.setdefault(key,0)
+		self.times.setdefault(key,0.0)
+		self.depth.setdefault(key,0)
+		def counted(*args,**kwargs):
+			if outer and self.depth[key]:
+				return func(*args,**kwargs)
+			self.counts[key] += 1
+			self.depth[key] += 1
+			start = time.perf_counter()
+			try:
+				return func(*args,**kwargs)
+			finally:
+				self.times[key] += time.perf_counter()-start
+				self.depth[key] -= 1
+		setattr(owner,name,counted)
+
+	def restore(self):
+		for (owner,name,func) in self.saved[::-1]:
+			if func == None:
+				delattr(owner,name)
+			else:
+				setattr(owner,name,func)
+		self.saved = []
+
+def run_case(case,mode):
+	# Build one case in this process, returning its timings, counters and geometry
+	if mode in ['merged','visual']:
+		from pymol import cmd
+	import builder
+	root_pdb,peptides,points = BENCH_UNITS[case['unit']]
+	unit = builder.read_sheet_unit(os.path.join(ROOT,root_pdb),peptides,points)
+	fibril = builder.create_fibril(unit)
+	fibril.mode = mode
+	fibril.monitor = builder.build_monitor(echo=0)
+	counter = call_counter()
+	for name in COUNT_METHODS:
+		counter.wrap(builder.create_fibril,name,name)
+	for (key,lo_name) in TIME_METHODS.items():
+		for name in lo_name:
+			counter.wrap(builder.create_fibril,name,key+'_time',outer=1)
+	if mode in ['merged','visual']:
+		for name in dir(cmd):
+			if (not name.startswith('_')) and callable(getattr(cmd,name)) and (type(getattr(cmd,name)).__name__ == 'function'):
+				counter.wrap(cmd,name,'pymol.cmd',outer=1)
+	rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	with tempfile.TemporaryDirectory() as root_tmp:
+		fibril.root_out = os.path.join(root_tmp,'bench.pdb')
+		start = time.perf_counter()
+		getattr(fibril,case['method'])(*case['args'])
+		wall_time = time.perf_counter()-start
+	counter.restore()
+	record = fibril.monitor.records[-1]
+	result = {'wall_time':wall_time,\
+				'refine_time':counter.times['refine_time'],\
+				'emit_time':counter.times['emit_time'],\
+				'peak_rss_kb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,\
+				'base_rss_kb':rss_base,\
+				'pymol_cmd':counter.counts.get('pymol.cmd',0),\
+				'status':record['status'],\
+				'phase_time':record['times'],\
+				'iterations':record['counts'].get('iterations',0),\
+				'log':'\n'.join(record['messages'])}
+	for name in COUNT_METHODS:
+		result[name] = counter.counts[name]
+	if record['status'] == 'accept':
+		result['num_copies'] = len(fibril.table['pep'])
+		result['num_atoms'] = fibril.get_size()[0]
+		for key in ['angle_z','angle_y','radius','pitch','period']:
+			result[key] = float(getattr(fibril,key))
+	return result
+
+def run_isolated(case,mode):
+	# One fresh process per case, so that peak RSS and PyMOL state belong to this case only
+	with multiprocessing.get_context('spawn').Pool(1) as pool:
+		return pool.apply(run_case,(case,mode))
+
+def run_benchmark(cases,mode='merged',repeat=1,isolate=1):
+	# Run every case (the fastest of repeat runs), returning a dict that is written as JSON
+	results = {}
+	for case in cases:
+		lo_result = []
+		for k in range(repeat):
+			if isolate:
+				lo_result += [run_isolated(case,mode)]
+			else:
+				lo_result += [run_case(case,mode)]
+		result = min(lo_result,key=lambda r:r['wall_time'])
+		result.update({'morphology':case['morphology'],'unit':case['unit'],'method':case['method'],'args':case['args']})
+		results[case['name']] = result
+	return {'meta':get_meta(mode,repeat,isolate),'cases':results}
+
+def get_meta(mode,repeat,isolate):
+	# Versions and settings that make two benchmark files comparable
+	try:
+		commit = subprocess.run(['git','rev-parse','HEAD'],cwd=ROOT,capture_output=True,text=True).stdout.strip()
+	except OSError:
+		commit = ''
+	pymol_version = ''
+	if mode in ['merged','visual']:
+		from pymol import cmd
+		pymol_version = cmd.get_version()[0]
+	return {'commit':commit,'python':platform.python_version(),'numpy':np.__version__,'pymol':pymol_version,\
+			'machine':platform.machine(),'mode':mode,'repeat':repeat,'isolate':isolate}
+
+def compare(old,new,keys=['wall_time','peak_rss_kb','check_unit','unit_is_not_clashed','pymol_cmd']):
+	# Lines of new/old ratios of the cases found in both results
+	lines = []
+	for name in sorted(set(old['cases'])&set(new['cases'])):
+		a,b = old['cases'][name],new['cases'][name]
+		fields = [name]
+		for key in keys:
+			if (key in a) and (key in b):
+				fields += [key+' '+str(round(b[key],4))+' ('+('x'+str(round(b[key]/a[key],2)) if a[key] else 'new')+')']
+		if a['status'] != b['status']:
+			fields += ['status '+a['status']+' -> '+b['status']]
+		lines += ['  '.join(fields)]
+	return lines
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Time the example builds of builder.py and their scaled versions.')
+	parser.add_argument('--units',nargs='+',default=None,choices=sorted(BENCH_UNITS),help='bilayers (default: all)')
+	parser.add_argument('--cases',nargs='+',default=['*'],help='case name patterns, e.g. "capF8/*" "*/s_rod/k*"')
+	parser.add_argument('--mode',default='merged',choices=['merged','none','file','visual'],help='output mode of the builds')
+	parser.add_argument('--repeat',type=int,default=1,help='runs per case, the fastest is kept')
+	parser.add_argument('--inline',action='store_true',help='run every case in this process (peak RSS is then cumulative)')
+	parser.add_argument('--list',action='store_true',help='only list the cases')
+	parser.add_argument('--compare',default=None,help='an earlier result to compare with')
+	parser.add_argument('--out',default='bench.json')
+	args = parser.parse_args(argv)
+
+	cases = [case for case in get_cases(args.units) if any(fnmatch.fnmatch(case['name'],p) for p in args.cases)]
+	if args.list:
+		for case in cases:
+			print (case['name']+'  '+case['method']+str(tuple(case['args'])))
+		return
+	results = run_benchmark(cases,args.mode,args.repeat,not args.inline)
+	with open(args.out,'w') as f:
+		json.dump(results,f,indent=1,sort_keys=True)
+		f.write('\n')
+	for (name,result) in sorted(results['cases'].items()):
+		print (name+'  '+result['status']+'  '+str(round(result['wall_time'],3))+' s  '+str(result['peak_rss_kb'])+' kB')
+	if args.compare:
+		with open(args.compare) as f:
+			old = json.load(f)
+		print ('\n'.join(compare(old,results)))
+	print (str(len(cases))+' cases written to '+args.out)
+
+if __name__ == '__main__':
+	main()
@@ -1,22 +1,57 @@
 # run builder.py
 
+import os
+import sys
+import contextlib
+import functools
+import itertools
 import numpy as np
-import pymol
 import math
-from pymol.cgo import *
+# Make modules next to builder.py importable under the PyMOL run command
+sys.path.insert(0,os.path.dirname(os.path.abspath(globals().get('__script__') or __file__)))
+from engine import *
+from cache import refine_cache,cached_refinement
+from monitor import build_monitor,monitored_build,monitored_phase
+from model import fibril_model
+from pdbio import *
+
+class lazy_pymol():
+	# Import PyMOL on first use, so that NumPy-only work (e.g. sweep workers) never starts it
+	def __getattr__(self,key):
+		import pymol
+		return getattr(pymol,key)
+
+if 'pymol' in sys.modules:
+	import pymol
+else:
+	pymol = lazy_pymol()
+
+# Numbers of the unit and fibril instances, whose PyMOL objects are named after them
+INSTANCE_IDS = itertools.count(1)
+
+def get_instance_name(kind):
+	# A name no other instance of this process uses, e.g. 'fibril3'
+	return kind+str(next(INSTANCE_IDS))
 
 def get_ca(name):
-	pymol.cmd.select('lo_ca','name ca and '+name)
-	pos_ca = pymol.cmd.get_coords('lo_ca',1)
+	# Selection expressions instead of named selections, so that no global name is overwritten
+	pos_ca = pymol.cmd.get_coords('name ca and ('+name+')',1)
 	return np.array(pos_ca)
 
+def get_template(name):
+	model = pymol.cmd.get_model(name)
+	atoms = model.atom
+	return atom_template(model.get_coord_list(),[a.name for a in atoms],[a.resn for a in atoms],[a.resi_number for a in atoms],\
+				[a.chain for a in atoms],[a.symbol for a in atoms])
+
 def get_com(name):
 	return np.mean(np.array(pymol.cmd.get_coords(name,1)),0)
 
 def get_boundary(lo_name):
+	# Bounds of PyMOL selections, or of coordinate arrays
 	lop = []
 	for name in lo_name:
-		lop += pymol.cmd.get_coords(name,1).tolist()
+		lop += (pymol.cmd.get_coords(name,1) if isinstance(name,str) else name).tolist()
 	lop = np.array(lop)
 	return [max(lop[:,0]),min(lop[:,0]),max(lop[:,1]),min(lop[:,1]),max(lop[:,2]),min(lop[:,2])]
 
@@ -26,8 +61,7 @@ def rotate_coordinate(name,coord):
 
 def check_clash(lon,dist_tolorence):
 	for name in lon:
-		pymol.cmd.select('contacts',name+' around '+str(dist_tolorence))
-		print (name,pymol.cmd.get_coords('contacts',1))
+		print (name,pymol.cmd.get_coords('('+name+') around '+str(dist_tolorence),1))
 
 def get_bounding_vertices(box_boundaries):
 	minX,minY,minZ,maxX,maxY,maxZ = box_boundaries[1],box_boundaries[3],box_boundaries[5],box_boundaries[0],box_boundaries[2],box_boundaries[4]
@@ -38,55 +72,37 @@ def get_bounding_vertices(box_boundaries):
 	return loPoints
 
 def draw_box(loPoints,boxName):
-	linewidth, r, g, b = 2.0, 1.0, 0.0, 0.0
-	boundingBox = [
-		LINEWIDTH, float(linewidth),
-
-		BEGIN, LINES,
-		COLOR, float(r), float(g), float(b),
-
-		VERTEX, loPoints[0][0], loPoints[0][1], loPoints[0][2],       #1
-		VERTEX, loPoints[1][0], loPoints[1][1], loPoints[1][2],       #2
-
-		VERTEX, loPoints[2][0], loPoints[2][1], loPoints[2][2],       #3
-		VERTEX, loPoints[3][0], loPoints[3][1], loPoints[3][2],       #4
-
-		VERTEX, loPoints[4][0], loPoints[4][1], loPoints[4][2],       #5
-		VERTEX, loPoints[5][0], loPoints[5][1], loPoints[5][2],       #6
-
-		VERTEX, loPoints[6][0], loPoints[6][1], loPoints[6][2],       #7
-		VERTEX, loPoints[7][0], loPoints[7][1], loPoints[7][2],       #8
-
-
-		VERTEX, loPoints[0][0], loPoints[0][1], loPoints[0][2],       #1
-		VERTEX, loPoints[4][0], loPoints[4][1], loPoints[4][2],       #5
-
-		VERTEX, loPoints[2][0], loPoints[2][1], loPoints[2][2],       #3
-		VERTEX, loPoints[6][0], loPoints[6][1], loPoints[6][2],       #7
-
-		VERTEX, loPoints[3][0], loPoints[3][1], loPoints[3][2],       #4
-		VERTEX, loPoints[7][0], loPoints[7][1], loPoints[7][2],       #8
-
-		VERTEX, loPoints[1][0], loPoints[1][1], loPoints[1][2],       #2
-		VERTEX, loPoints[5][0], loPoints[5][1], loPoints[5][2],       #6
-
-
-		VERTEX, loPoints[0][0], loPoints[0][1], loPoints[0][2],       #1
-		VERTEX, loPoints[2][0], loPoints[2][1], loPoints[2][2],       #3
-
-		VERTEX, loPoints[4][0], loPoints[4][1], loPoints[4][2],       #5
-		VERTEX, loPoints[6][0], loPoints[6][1], loPoints[6][2],       #7
+	draw_boxes(np.array(loPoints).reshape((1,8,3)),boxName)
+	return
 
-		VERTEX, loPoints[1][0], loPoints[1][1], loPoints[1][2],       #2
-		VERTEX, loPoints[3][0], loPoints[3][1], loPoints[3][2],       #4
+def draw_boxes(vertices,boxName,detail='full'):
+	# Draw (N,8,3) box vertices as a single CGO object, with 12 edges per box ('full') or the long axis only ('low')
+	from pymol.cgo import LINEWIDTH,BEGIN,LINES,COLOR,VERTEX,END
+	linewidth, r, g, b = 2.0, 1.0, 0.0, 0.0
+	if detail == 'low':
+		points = np.stack([np.mean(vertices[:,:4],1),np.mean(vertices[:,4:],1)],axis=1)
+	else:
+		points = vertices[:,BOX_EDGES.reshape(-1)]
+	lines = np.zeros((points.shape[0]*points.shape[1],4))
+	lines[:,0] = VERTEX
+	lines[:,1:] = points.reshape((-1,3))
+	boundingBox = [LINEWIDTH,float(linewidth),BEGIN,LINES,COLOR,float(r),float(g),float(b)]+lines.reshape(-1).tolist()+[END]
+	pymol.cmd.load_cgo(boundingBox,boxName)
+	return
 
-		VERTEX, loPoints[5][0], loPoints[5][1], loPoints[5][2],       #6
-		VERTEX, loPoints[7][0], loPoints[7][1], loPoints[7][2],       #8
+# Vertex pairs of the 12 box edges
+BOX_EDGES = np.array([[0,1],[2,3],[4,5],[6,7],[0,4],[2,6],[3,7],[1,5],[0,2],[4,6],[1,3],[5,7]])
 
-		END
-		]
-	cmd.load_cgo(boundingBox,boxName)
-	return
+def load_frames(root_out,name=None):
+	# Load the frames written in the 'frames' mode as the states of one PyMOL object
+	if name == None:
+		name = os.path.splitext(os.path.basename(root_out))[0]
+	if root_out.lower().endswith('.dcd'):
+		pymol.cmd.load(os.path.splitext(root_out)[0]+'.pdb',name)
+		pymol.cmd.load_traj(root_out,name,1)
+	else:
+		pymol.cmd.load(root_out,name)
+	return name
 
 def example(morphology):
 	## Reset
@@ -111,6 +127,7 @@ def example(morphology):
 	## Change default geo parameters
 	# fibril.tilt_s1, fibril.tilt_s2 = 0, 0
 	# fibril.dist_tolorence = 1.0
+	# fibril.mode = 'visual'
 
 	## --- Examples of structures ---
 	## Build a plain sheet (num of units per sheet)
@@ -140,47 +157,47 @@ def example(morphology):
 
 
 class create_sheet_unit():
-	# INPUT (sheet 1 peptide 1, sheet 1 peptide 2, sheet 2 peptide 1, sheet 2 peptide 2, point for x head, point for x tail, point for y)
-	def __init__(self,pep1_s1,pep2_s1,pep1_s2,pep2_s2,po1,po2,po3):
+	# INPUT (sheet 1 peptide 1, sheet 1 peptide 2, sheet 2 peptide 1, sheet 2 peptide 2, point for x head, point for x tail, point for y, name)
+	def __init__(self,pep1_s1,pep2_s1,pep1_s2,pep2_s2,po1,po2,po3,name=None):
+		# The peptides are shown as name_s1_pep1, ... in the group name, a new name per unit by default
+		self.name = name or get_instance_name('unit')
+		lo_object = [self.name+'_'+pep for pep in PEP_NAMES]
 		# Create a unit
-		pymol.cmd.create('s1_pep1',pep1_s1,0,0,1)
-		pymol.cmd.create('s1_pep2',pep2_s1,0,0,1)
-		pymol.cmd.create('s2_pep1',pep1_s2,0,0,1)
-		pymol.cmd.create('s2_pep2',pep2_s2,0,0,1)
+		for (obj,pep) in zip(lo_object,[pep1_s1,pep2_s1,pep1_s2,pep2_s2]):
+			pymol.cmd.create(obj,pep,0,0,1)
+		pymol.cmd.group(self.name,' '.join(lo_object))
 		# Create a cooridinate
-		coord = self.get_coordinate_by_xy(po1,po2,po3)
-		# Center the unit
-		pymol.cmd.group('unit','s1_pep1 s1_pep2 s2_pep1 s2_pep2')
-		com = np.mean(get_ca('unit'),0)
-		pymol.cmd.translate((-com).tolist(),'s1_pep1')
-		pymol.cmd.translate((-com).tolist(),'s1_pep2')
-		pymol.cmd.translate((-com).tolist(),'s2_pep1')
-		pymol.cmd.translate((-com).tolist(),'s2_pep2')
-		# Align the unit to the coordinate
-		rotate_coordinate('s1_pep1',coord)
-		rotate_coordinate('s1_pep2',coord)
-		rotate_coordinate('s2_pep1',coord)
-		rotate_coordinate('s2_pep2',coord)
+		coord = np.array(self.get_coordinate_by_xy(po1,po2,po3))
+		# Center the unit and align it to the coordinate in NumPy, keeping the four peptides as atom arrays
+		templates = [get_template(obj) for obj in lo_object]
+		com = np.mean(np.concatenate([t.get_ca() for t in templates]),0)
+		self.templates = {}
+		for (name,obj,t) in zip(PEP_NAMES,lo_object,templates):
+			self.templates[name] = atom_template(np.dot(t.coords-com,coord.T),t.name,t.resn,t.resi,t.chain,t.elem)
+			pymol.cmd.load_coords(self.templates[name].coords.tolist(),obj)
 		# Set dimensions
-		ca_s1 = np.mean(get_ca('s1_pep1').tolist()+get_ca('s1_pep2').tolist(),0)
-		ca_s2 = np.mean(get_ca('s2_pep1').tolist()+get_ca('s2_pep2').tolist(),0)
+		self.set_geometry()
+		# Draw bounding box
+		draw_box(get_bounding_vertices(self.box_boundaries),self.name+'_UnitBox')
+
+	def set_geometry(self):
+		# Dimensions of the unit from the aligned template peptides
+		ca = dict([(name,self.templates[name].get_ca()) for name in PEP_NAMES])
+		ca_s1 = np.mean(ca['s1_pep1'].tolist()+ca['s1_pep2'].tolist(),0)
+		ca_s2 = np.mean(ca['s2_pep1'].tolist()+ca['s2_pep2'].tolist(),0)
 		self.d = (ca_s2-ca_s1)[2]
-		self.b1 = np.mean(get_ca('s1_pep2'),0)[1]-np.mean(get_ca('s1_pep1'),0)[1]
-		self.b2 = np.mean(get_ca('s2_pep2'),0)[1]-np.mean(get_ca('s2_pep1'),0)[1]
+		self.b1 = np.mean(ca['s1_pep2'],0)[1]-np.mean(ca['s1_pep1'],0)[1]
+		self.b2 = np.mean(ca['s2_pep2'],0)[1]-np.mean(ca['s2_pep1'],0)[1]
 		self.b = min(self.b1,self.b2)
-		boundary = get_boundary(['s1_pep1','s1_pep2'])
+		boundary = get_boundary([self.templates[name].coords for name in PEP_NAMES[:2]])
 		self.l = boundary[0]-boundary[1]
-		self.box_boundaries = get_boundary(['s1_pep1','s1_pep2','s2_pep1','s2_pep2'])
+		self.box_boundaries = get_boundary([self.templates[name].coords for name in PEP_NAMES])
 		self.box_w = self.box_boundaries[4]-self.box_boundaries[5]
 		self.box_l = self.box_boundaries[0]-self.box_boundaries[1]
-		# Draw bounding box
-		draw_box(get_bounding_vertices(self.box_boundaries),'UnitBox')
-
 
 	def get_coordinate_by_xy(self,po1,po2,po3):
-		pos_po1 = np.array(pymol.cmd.get_coords(po1,1)).reshape(3)
-		pos_po2 = np.array(pymol.cmd.get_coords(po2,1)).reshape(3)
-		pos_po3 = np.array(pymol.cmd.get_coords(po3,1)).reshape(3)
+		# Reference points as PyMOL selections of one atom, or as coordinates
+		pos_po1,pos_po2,pos_po3 = [np.array(pymol.cmd.get_coords(po,1) if isinstance(po,str) else po).reshape(3) for po in [po1,po2,po3]]
 		x = pos_po2 - pos_po1
 		y = pos_po3 - pos_po1
 		z = np.cross(x,y)
@@ -188,327 +205,648 @@ class create_sheet_unit():
 		unit_x,unit_y,unit_z = x/np.linalg.norm(x),y/np.linalg.norm(y),z/np.linalg.norm(z)
 		return [unit_x,unit_y,unit_z]
 
+class read_sheet_unit(create_sheet_unit):
+	# INPUT (PDB file, residue ranges of the four peptides, reference atoms as resi/name for x head, x tail and y), without PyMOL
+	def __init__(self,root_pdb,peptides,points):
+		atoms = read_pdb(root_pdb)
+		# Create a cooridinate
+		lo_pos = []
+		for point in points:
+			resi,name = point.split('/')
+			idx = select_atoms(atoms,resi,name)
+			if len(idx) != 1:
+				raise ValueError('Reference atom '+point+' matches '+str(len(idx))+' atoms')
+			lo_pos += [atoms['coords'][idx[0]]]
+		coord = np.array(self.get_coordinate_by_xy(*lo_pos))
+		# Create a unit
+		lo_idx = [select_atoms(atoms,resi) for resi in peptides]
+		# Center the unit
+		com = np.mean(np.concatenate([atoms['coords'][idx][np.char.upper(atoms['name'][idx]) == 'CA'] for idx in lo_idx]),0)
+		# Align the unit to the coordinate
+		self.templates = {}
+		for (name,idx) in zip(PEP_NAMES,lo_idx):
+			self.templates[name] = atom_template(np.dot(atoms['coords'][idx]-com,coord.T),atoms['name'][idx],atoms['resn'][idx],\
+									atoms['resi'][idx],atoms['chain'][idx],atoms['elem'][idx])
+		# Set dimensions
+		self.set_geometry()
+
+def verified_refinement(func):
+	# Run a create_fibril.refine_* method at fibril.resolution. With fibril.verify, a bead model result gets one all-atom clash test at the
+	# returned parameters, and the refinement is run again with all atoms only if that test fails
+	@functools.wraps(func)
+	def wrapper(self,*args):
+		value = func(self,*args)
+		if (self.resolution == 'atom') or (not self.verify) or (value == None):
+			return value
+		self.count('verifications')
+		with self.at_resolution('atom'):
+			if self.check_refinement(func.__name__,args,value):
+				return value
+			self.count('verify_failures')
+			return func(self,*args)
+	return wrapper
+
 
 class create_fibril():
-	def __init__(self,unit): 
+	def __init__(self,unit,name=None): 
 		self.unit = unit
+		# PyMOL objects of this fibril are prefixed by its name (a new name per fibril by default), so that fibrils can be built concurrently
+		self.name = name or get_instance_name('fibril')
 		# Default tilt angle
 		self.tilt_s1 = 0
 		self.tilt_s2 = 0
 		# Default tolorence
 		self.dist_tolorence = 0.6
+		# Contact distances are reported exactly up to this reach
+		self.contact_reach = 2.0
+		# Clash tests on 'atom' (all atoms), or on 'backbone' (N, CA, C, O) or 'ca' beads
+		self.resolution = 'atom'
+		# Check a bead model refinement with all atoms at the converged parameters
+		self.verify = 1
+		# Bead contact of a clash, calibrated against all-atom tests on the bundled bilayers
+		self.bead_tolorence = {'backbone':1.0,'ca':2.75}
+		self.beads = None
+		# Iterations of refine_theta, refine_theta_radius and refine_stack_rod, and the grid span and candidates of refine_stack_ribbon
+		self.refine_iterations = 40
+		# Search range and tolorence of the twist angle (degree)
+		self.twist_limit = 8.0
+		self.twist_tolorence = 0.05
+		# Refinement cache, e.g. refine_cache('.fibrilgen_cache') (None to disable)
+		self.cache = None
+		# Output mode: 'merged' (a single object), 'none' (NumPy only), 'file' (streamed to root_out), 'visual' (an object per peptide)
+		# or 'frames' (every build appended as a frame of root_out, a multi-model .pdb or a .dcd with its topology in a .pdb)
+		self.mode = 'merged'
+		self.root_out = None
+		self.frames = None
+		# Bounding boxes: 'full', 'low' (the long axis of every box) or 'none'
+		self.box_detail = 'full'
+		# Number of clash tests of unit neighbor shells so far, and of the last refinement (0 if it came from the cache)
+		self.num_clash_evaluations = 0
+		self.refine_evaluations = 0
+		# Placement of the last build, see extend and extend_stack
+		self.layout = None
+		self.raw_coords = []
+		# Instrumentation, e.g. build_monitor(callback) for phase timers, counters and a record of every build (None to disable)
+		self.monitor = None
+
+	def get_name(self,name):
+		# Name of a PyMOL object of this fibril
+		return self.name+'_'+name
+
+	def phase(self,name):
+		# Time a phase ('refine', 'clash', 'transform' or 'output') with the monitor
+		if self.monitor == None:
+			return contextlib.nullcontext()
+		return self.monitor.phase(name)
+
+	def count(self,name,num=1):
+		if self.monitor != None:
+			self.monitor.count(name,num)
+
+	def report(self,text):
+		# Messages go to the monitor if there is one, else to stdout
+		if self.monitor == None:
+			print (text)
+		else:
+			self.monitor.message(text)
+
+	def get_clash_templates(self):
+		# Template peptides of the clash tests at self.resolution
+		if self.resolution == 'atom':
+			return self.unit.templates
+		if (self.beads == None) or (self.beads[0] is not self.unit) or (self.beads[1] != self.resolution):
+			self.beads = (self.unit,self.resolution,dict([(pep,t.get_beads(self.resolution)) for (pep,t) in self.unit.templates.items()]))
+		return self.beads[2]
+
+	def get_clash_tolorence(self):
+		# Contact distance of a clash at self.resolution
+		if self.resolution == 'atom':
+			return self.dist_tolorence
+		return self.bead_tolorence[self.resolution]
+
+	def is_clear(self,get_contact):
+		# Clash test of the contact get_contact(stop) at self.resolution
+		tolorence = self.get_clash_tolorence()
+		if get_contact(tolorence) > tolorence:
+			return 1
+		else:
+			return 0
+
+	@contextlib.contextmanager
+	def at_resolution(self,resolution):
+		resolution,self.resolution = self.resolution,resolution
+		try:
+			yield
+		finally:
+			self.resolution = resolution
 
-	def check_unit(self,angle_z,angle_y,z_sign,y_sign,radius):
-		max_twist = 0
-		for i in range(21):
-			angle = 0 + i*0.4
-			if self.unit_is_not_clashed(angle_z,angle,z_sign,y_sign,radius):
-				max_twist = angle
+	def check_unit(self,angle_z,angle_y,z_sign,y_sign,radius,angle_stack=None):
+		max_twist = self.get_max_twist(angle_z,z_sign,y_sign,radius,angle_y,angle_stack)
 		if max_twist > angle_y:
 			return 1
 		else:
 			return 0
 
-	def unit_is_not_clashed(self,angle_z,angle_y,z_sign,y_sign,radius):
-		def is_clash(name):
-			pymol.cmd.select('contacts',name+' around '+str(self.dist_tolorence))
-			if pymol.cmd.get_coords('contacts',1) is not None:
-				return 1
+	def get_max_twist(self,angle_z,z_sign,y_sign,radius,angle_y=None,angle_stack=None):
+		# Bisection for the largest clash-free twist angle in [0, twist_limit]
+		lo,hi = 0,self.twist_limit
+		if self.unit_is_not_clashed(angle_z,hi,z_sign,y_sign,radius,angle_stack):
+			return hi
+		while hi-lo > self.twist_tolorence:
+			# Stop once the twist is known to be above (or below) angle_y
+			if (angle_y != None) and ((lo > angle_y) or (hi <= angle_y)):
+				break
+			angle = (lo+hi)/2.0
+			if self.unit_is_not_clashed(angle_z,angle,z_sign,y_sign,radius,angle_stack):
+				lo = angle
 			else:
-				return 0
-
-		# Testing by a far away unit
-		i = 0
-		z_sign1 = z_sign[0]
-		name_pep1,name_pep2,name_pep3 = 'test_s1_pep1','test_s1_pep2','test_s1_pep3'
-		pymol.cmd.create(name_pep1,'s1_pep1')
-		pymol.cmd.translate([0,0,radius],name_pep1)
-		self.affine_transformation(name_pep1,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i,[0,0,0],[0,self.unit.b1*2*i+200,0])
-		pymol.cmd.create(name_pep2,'s1_pep2')
-		pymol.cmd.translate([0,0,radius],name_pep2)
-		self.affine_transformation(name_pep2,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1),[0,-self.unit.b1,0],[0,self.unit.b1*(2*i+1)+200,0])
-		pymol.cmd.create(name_pep3,'s1_pep1')
-		pymol.cmd.translate([0,0,radius],name_pep3)
-		self.affine_transformation(name_pep3,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*(i+1),[0,0,0],[0,self.unit.b1*2*(i+1)+200,0])
-
-		z_sign2 = z_sign[1]
-		name_pep1,name_pep2,name_pep3 = 'test_s2_pep1','test_s2_pep2','test_s2_pep3'
-		pymol.cmd.create(name_pep1,'s2_pep1')
-		pymol.cmd.translate([0,0,radius],name_pep1)
-		self.affine_transformation(name_pep1,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i,[0,0,0],[0,self.unit.b2*2*i+200,0])
-		pymol.cmd.create(name_pep2,'s2_pep2')
-		pymol.cmd.translate([0,0,radius],name_pep2)
-		self.affine_transformation(name_pep2,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1),[0,-self.unit.b2,0],[0,self.unit.b2*(2*i+1)+200,0])
-		pymol.cmd.create(name_pep3,'s2_pep1')
-		pymol.cmd.translate([0,0,radius],name_pep3)
-		self.affine_transformation(name_pep3,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*(i+1),[0,0,0],[0,self.unit.b2*2*(i+1)+200,0])
-
-		# Check whether in close contacts
-		for name in ['test_s1_pep1','test_s1_pep2','test_s1_pep3','test_s2_pep1','test_s2_pep2','test_s2_pep3']:
-			if is_clash(name):
-				pymol.cmd.delete('test*')
-				return 0
-				
-		pymol.cmd.delete('test*')
-		return 1		
-
-
+				hi = angle
+		return lo
+
+	@monitored_phase('clash')
+	def unit_is_not_clashed(self,angle_z,angle_y,z_sign,y_sign,radius,angle_stack=None):
+		self.num_clash_evaluations += 1
+		self.count('clash_evaluations')
+		return self.is_clear(lambda stop:self.get_unit_contact(angle_z,angle_y,z_sign,y_sign,radius,angle_stack,stop))
+
+	def get_unit_contact(self,angle_z,angle_y,z_sign,y_sign,radius,angle_stack=None,stop=None):
+		# Minimum contact distance around one unit of a helical assembly (and around one stack, rotated by angle_stack, of a stacked ribbon),
+		# or the first contact found within stop
+		lo_unit = [(z_sign,[0,0,radius],0)]
+		if angle_stack != None:
+			lo_unit += [(z_sign,[0,0,radius],-angle_stack)]
+		return self.get_shell_contact(lo_unit,angle_z,angle_y,y_sign,1,stop)
+
+	@monitored_phase('clash')
+	def units_are_not_clashed(self,angle_z,angle_y,sign,lo_position):
+		# Contacts between the units (pos_z,pos_x) of a stacked rod, every unit against the units after it
+		lo_unit = [([np.sign(pos_z-self.unit.d/2.0)*sign,np.sign(pos_z+self.unit.d/2.0)*sign],[pos_x,0,pos_z],0) for (pos_z,pos_x) in lo_position]
+		# All pairs of units at once, the closest copies first
+		lo_link = [(a,b) for a in range(len(lo_unit)) for b in range(a+1,len(lo_unit))]
+		if len(lo_link) == 0:
+			return 1
+		return self.is_clear(lambda stop:self.get_shell_contact(lo_unit,angle_z,angle_y,-sign,0,stop,lo_link))
+
+	def get_shell_contact(self,lo_unit,angle_z,angle_y,y_sign,self_shell=1,stop=None,lo_link=None):
+		# Test the copies of strands 0 and 1 of a reference unit lo_unit[0] against its symmetry-unique neighbours: strands i+-1 and i+-2 of
+		# the same unit (if self_shell), and every strand within reach in the adjacent units lo_unit[1:] (z_sign of each sheet, translation1, angle_y offset).
+		# lo_link lists the (reference, adjacent) unit pairs instead, e.g. every pair of units
+		cell = max(self.get_clash_tolorence(),self.contact_reach)
+		clash_templates = self.get_clash_templates()
+		if lo_link == None:
+			lo_link = [(0,u) for u in range(1,len(lo_unit))]
+		lo_link = np.array(lo_link,dtype=int).reshape((-1,2))
+		window = self.get_shell_window(cell) if len(lo_link) else 0
+		# Copies of strands first_n..last_n of both sheets of every unit, as copy (u*2+s)*num_n+n-first_n
+		first_n,last_n = -max(window,2),1+max(window,2)
+		num_n = last_n-first_n+1
+		def get_copy(u,s,n):
+			return (u*2+s)*num_n+n-first_n
+		lo_pair = []
+		if self_shell:
+			# Pairs in the reference unit, up to a translation of both strands by a unit along the axis
+			lo_key = set()
+			for (s,n) in [(s,n) for s in (0,1) for n in (0,1)]:
+				for (s_b,n_b) in [(s_b,n_b) for s_b in (0,1) for n_b in range(n-2,n+3)]:
+					shift = min(n,n_b)-min(n,n_b)%2
+					key = frozenset([(s,n-shift),(s_b,n_b-shift)])
+					if (len(key) == 2) and (key not in lo_key):
+						lo_key.add(key)
+						lo_pair += [(get_copy(0,s,n),get_copy(0,s_b,n_b))]
+		lo_pair = np.array(lo_pair,dtype=int).reshape((-1,2))
+		if len(lo_link):
+			# Strands 0 and 1 of the reference unit against every strand within the window of the adjacent unit
+			s,n,s_b,d = [v.reshape(-1) for v in np.meshgrid([0,1],[0,1],[0,1],np.arange(-window,window+1),indexing='ij')]
+			idx_a = get_copy(lo_link[:,0,None],s[None,:],n[None,:])
+			idx_b = get_copy(lo_link[:,1,None],s_b[None,:],(n+d)[None,:])
+			lo_pair = np.concatenate([lo_pair,np.stack([idx_a.reshape(-1),idx_b.reshape(-1)],axis=1)])
+		# One batched transformation per template peptide
+		num_copy = 2*num_n*len(lo_unit)
+		lo_u,lo_s,lo_n = np.arange(num_copy)//(2*num_n),(np.arange(num_copy)//num_n)%2,np.arange(num_copy)%num_n+first_n
+		z_sign = np.array([lo_unit[u][0] for u in range(len(lo_unit))],dtype=float).reshape((len(lo_unit),-1))
+		z_sign = np.broadcast_to(z_sign,(len(lo_unit),2))[lo_u,lo_s]
+		translation1 = np.array([lo_unit[u][1] for u in range(len(lo_unit))],dtype=float)[lo_u]
+		offset_y = np.array([lo_unit[u][2] for u in range(len(lo_unit))],dtype=float)[lo_u]
+		templates,matrices,shifts = [None]*num_copy,np.zeros((num_copy,3,3)),np.zeros((num_copy,3))
+		for pep in PEP_NAMES:
+			s,p = int(pep[1])-1,int(pep[-1])-1
+			idx = np.where((lo_s == s)&(lo_n%2 == p))[0]
+			tilt,b = [(self.tilt_s1,self.unit.b1),(self.tilt_s2,self.unit.b2)][s]
+			matrix,shift = get_rigid_transforms(clash_templates[pep],z_sign[idx]*(angle_z+tilt),y_sign*angle_y*lo_n[idx]+offset_y[idx],\
+							translation1[idx],along_y(b*lo_n[idx]))
+			for k in idx.tolist():
+				templates[k] = clash_templates[pep]
+			matrices[idx],shifts[idx] = matrix,shift
+		return get_min_contact(templates,matrices,shifts,cell,lo_pair,stop)
+
+	def get_shell_window(self,cell):
+		# Number of strands along the axis beyond which two copies cannot be within cell
+		bound = max([np.max(np.linalg.norm(t.coords-np.mean(t.coords,0),axis=1)) for t in self.unit.templates.values()])
+		return int(np.ceil((2*bound+cell)/min(self.unit.b1,self.unit.b2)))
+
+
+	@monitored_build
 	def build_a_flat_sheet(self,num_half):
-		# Build the first sheet of the bilayer
-		for i in range(num_half):
-			name_pep1,name_pep2 = 'p_s1_pep1_'+str(i),'p_s1_pep2_'+str(i)
-			pymol.cmd.create(name_pep1,'s1_pep1')
-			pymol.cmd.translate([0,self.unit.b1*2*i,0],name_pep1)
-			pymol.cmd.create(name_pep2,'s1_pep2')
-			pymol.cmd.translate([0,self.unit.b1*2*i,0],name_pep2)
-		# Build the second sheet of the bilayer
-		for i in range(num_half):
-			name_pep1,name_pep2 = 'p_s2_pep1_'+str(i),'p_s2_pep2_'+str(i)
-			pymol.cmd.create(name_pep1,'s2_pep1')
-			pymol.cmd.translate([0,self.unit.b2*2*i,0],name_pep1)
-			pymol.cmd.create(name_pep2,'s2_pep2')
-			pymol.cmd.translate([0,self.unit.b2*2*i,0],name_pep2)
-		# Build box representation
-		for i in range(num_half):
-			name_box = 'vis_'+str(i)
-			self.affine_transformation_a_box(name_box,0,0,[0,0,0],[0,self.unit.b1*2*i,0])
-		pymol.cmd.color('green','p_s1_*')
-		pymol.cmd.color('orange','p_s2_*')
-		pymol.cmd.group('plain_sheet','p_*')
-		pymol.cmd.group('visBox','vis_*')
+		def place_layers(i,lo_stack):
+			# Build the first sheet of the bilayer
+			self.place('s1_pep1',i,0,0,0,[0,0,0],along_y(self.unit.b1*2*i),0)
+			self.place('s1_pep2',i,0,0,0,[0,0,0],along_y(self.unit.b1*2*i),0)
+			# Build the second sheet of the bilayer
+			self.place('s2_pep1',i,0,0,0,[0,0,0],along_y(self.unit.b2*2*i),0)
+			self.place('s2_pep2',i,0,0,0,[0,0,0],along_y(self.unit.b2*2*i),0)
+			# Build box representation
+			self.place_box(0,0,[0,0,0],along_y(self.unit.b1*2*i))
+		self.set_layout(place_layers,'p_','plain_sheet',0,num_half)
 		self.set_dimension(0,0,0,self.unit.b)
-		return
+		return self.get_model()
 
+	@monitored_build
 	def build_a_stacked_sheet(self,stacking,num_half):
 		# Get a position matrix
 		stacking = np.array(stacking)
-		stack_z,stack_x = stacking.shape
-		pos_matrix = np.zeros((stack_z,stack_x,2))
-		started_z,started_x = (stack_z-1)/2.0,(stack_x-1)/2.0
-		dist_z = self.unit.box_w
-		dist_x = self.unit.box_l
-		for j in range(stack_z):
-			for k in range(stack_x):
-				pos_matrix[j,k,0] = (started_z-j)*dist_z
-				pos_matrix[j,k,1] = (-started_x+k)*dist_x
-		idx_unit = 0
-		for (pos,stack_this) in zip(pos_matrix.reshape((-1,2)).tolist(),stacking.flatten()):
-			if stack_this:
-				# Get param
-				pos_z,pos_x = pos
-				# Build the structure
-				for i in range(num_half):
-					name = str(i)+'_'+str(idx_unit)
-					name_pep1,name_pep2 = 'sp_s1_pep1_'+name,'sp_s1_pep2_'+name
-					pymol.cmd.create(name_pep1,'s1_pep1')
-					pymol.cmd.translate([pos_x,self.unit.b1*2*i,pos_z],name_pep1)
-					pymol.cmd.create(name_pep2,'s1_pep2')
-					pymol.cmd.translate([pos_x,self.unit.b1*2*i,pos_z],name_pep2)
-				for i in range(num_half):
-					name = str(i)+'_'+str(idx_unit)
-					name_pep1,name_pep2 = 'sp_s2_pep1_'+name,'sp_s2_pep2_'+name
-					pymol.cmd.create(name_pep1,'s2_pep1')
-					pymol.cmd.translate([pos_x,self.unit.b2*2*i,pos_z],name_pep1)
-					pymol.cmd.create(name_pep2,'s2_pep2')
-					pymol.cmd.translate([pos_x,self.unit.b2*2*i,pos_z],name_pep2)
-				for i in range(num_half):
-					name_box = 'vis_'+str(i)+'_'+str(idx_unit)
-					self.affine_transformation_a_box(name_box,0,0,[0,0,0],[pos_x,self.unit.b1*2*i,pos_z])
-				idx_unit += 1
-		pymol.cmd.color('green','sp_s1_*')
-		pymol.cmd.color('orange','sp_s2_*')
-		pymol.cmd.group('plain_sheet','sp_*')
-		pymol.cmd.group('visBox','vis_*')
+		pos_matrix = self.get_position_matrix(stacking,0)
+		lo_position = pos_matrix.reshape((-1,2))[stacking.reshape(-1) != 0]
+		def place_layers(i,lo_stack):
+			# Every layer of every unit at once
+			layer,idx_unit,pos = self.get_lattice(i,lo_position)
+			# Build the structure
+			self.place('s1_pep1',layer,idx_unit,0,0,[0,0,0],along_y(self.unit.b1*2*layer)+pos,0)
+			self.place('s1_pep2',layer,idx_unit,0,0,[0,0,0],along_y(self.unit.b1*2*layer)+pos,0)
+			self.place('s2_pep1',layer,idx_unit,0,0,[0,0,0],along_y(self.unit.b2*2*layer)+pos,0)
+			self.place('s2_pep2',layer,idx_unit,0,0,[0,0,0],along_y(self.unit.b2*2*layer)+pos,0)
+			self.place_box(0,0,[0,0,0],along_y(self.unit.b1*2*layer)+pos)
+		self.set_layout(place_layers,'sp_','plain_sheet',1,num_half)
 		self.set_dimension(0,0,0,self.unit.b)
-		return
+		return self.get_model()
 
 
+	@monitored_build
 	def build_a_rod(self,angle_z,num_half,sign):
 		radius = self.unit.d/2.0
 		# Refine the input geometry
 		param = self.refine_theta(angle_z*np.pi/180,radius,sign)
 		if param == None:
-			print ('Please decrease tilt angle!')
-			print ('Stop to update ... ')
+			self.report('Please decrease tilt angle!')
+			self.report('Stop to update ... ')
 			return
 		else:
 			theta_z,theta_y,y = param
 			angle_z,angle_y = theta_z*180/np.pi,theta_y*180/np.pi
-			z_sign1,y_sign = -sign,-sign
-			# Build the structure
-			for i in range(num_half):
-				name_pep1,name_pep2 = 'nr_s1_pep1_'+str(i),'nr_s1_pep2_'+str(i)
-				pymol.cmd.create(name_pep1,'s1_pep1')
-				self.affine_transformation(name_pep1,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i,[0,0,0],[0,y*2*i,0])
-				pymol.cmd.create(name_pep2,'s1_pep2')
-				self.affine_transformation(name_pep2,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1),[0,-self.unit.b1,0],[0,y*(2*i+1),0])
-			z_sign2,y_sign = sign,-sign
-			for i in range(num_half):
-				name_pep1,name_pep2 = 'nr_s2_pep1_'+str(i),'nr_s2_pep2_'+str(i)
-				pymol.cmd.create(name_pep1,'s2_pep1')
-				self.affine_transformation(name_pep1,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i,[0,0,0],[0,y*2*i,0])
-				pymol.cmd.create(name_pep2,'s2_pep2')
-				self.affine_transformation(name_pep2,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1),[0,-self.unit.b2,0],[0,y*(2*i+1),0])
-			for i in range(num_half):
-				name_box = 'vis_'+str(i)
-				self.affine_transformation_a_box(name_box,0,y_sign*theta_y*(2*i+0.5),[0,0,0],[0,y*2*i,0])
-
-			pymol.cmd.color('green','nr_s1_*')
-			pymol.cmd.color('orange','nr_s2_*')
-			pymol.cmd.group('a_rod','nr_*')
-			pymol.cmd.group('visBox','vis_*')
+			def place_layers(i,lo_stack):
+				z_sign1,y_sign = -sign,-sign
+				# Build the structure
+				self.place('s1_pep1',i,0,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i,[0,0,0],along_y(y*2*i))
+				self.place('s1_pep2',i,0,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1),[0,0,0],along_y(y*(2*i+1)))
+				z_sign2,y_sign = sign,-sign
+				self.place('s2_pep1',i,0,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i,[0,0,0],along_y(y*2*i))
+				self.place('s2_pep2',i,0,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1),[0,0,0],along_y(y*(2*i+1)))
+				self.place_box(0,y_sign*theta_y*(2*i+0.5),[0,0,0],along_y(y*2*i))
+			self.set_layout(place_layers,'nr_','a_rod',0,num_half)
 			self.set_dimension(radius,theta_z,theta_y,y)
-			return
+			return self.get_model()
 
+	@monitored_build
 	def build_a_stacked_rod(self,angle_z,stacking,num_half,sign):
 		# Get a position matrix
 		stacking = np.array(stacking)
-		stack_z,stack_x = stacking.shape
-		pos_matrix = np.zeros((stack_z,stack_x,2))
-		started_z,started_x = (stack_z-1)/2.0,(stack_x-1)/2.0
-		theta_z = angle_z*np.pi/180
-		dist_z = self.unit.box_w
-		dist_x = self.unit.box_l*np.cos(theta_z)+self.unit.b*np.sin(theta_z)
-		for j in range(stack_z):
-			for k in range(stack_x):
-				pos_matrix[j,k,0] = (started_z-j)*dist_z
-				pos_matrix[j,k,1] = (-started_x+k)*dist_x
+		pos_matrix = self.get_position_matrix(stacking,angle_z)
 		# Refine the input geometry
 		radius_matrix = (pos_matrix[:,:,0]**2+pos_matrix[:,:,1]**2)**0.5
-		param = self.refine_stack_rod(angle_z*np.pi/180,radius_matrix.reshape(-1),sign)
+		lo_position = pos_matrix.reshape((-1,2))[stacking.reshape(-1) != 0]
+		param = self.refine_stack_rod(angle_z*np.pi/180,radius_matrix.reshape(-1),sign,lo_position.tolist())
 		if (param == None):
-			print ('Please decrease tilt angle!')
-			print ('Stop to update ... ')
+			self.report('Please decrease tilt angle!')
+			self.report('Stop to update ... ')
 			return
 		else:
 			# Stacking
 			theta_z,theta_y,y = param
 			angle_z,angle_y = theta_z*180/np.pi,theta_y*180/np.pi
-			idx_unit = 0
-			for (pos,stack_this) in zip(pos_matrix.reshape((-1,2)).tolist(),stacking.flatten()):
-				if stack_this:
-					pos_z,pos_x = pos
-					y_sign = -sign
-					z_sign1 = np.sign(pos_z-self.unit.d/2.0)*sign
-					# Build the structure
-					for i in range(num_half):
-						name = str(i)+'_'+str(idx_unit)
-						name_pep1,name_pep2 = 'snr_s1_pep1_'+name,'snr_s1_pep2_'+name
-						pymol.cmd.create(name_pep1,'s1_pep1')
-						pymol.cmd.translate([pos_x,0,pos_z],name_pep1)
-						self.affine_transformation(name_pep1,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i,[0,0,0],[0,y*2*i,0])
-						pymol.cmd.create(name_pep2,'s1_pep2')
-						pymol.cmd.translate([pos_x,0,pos_z],name_pep2)
-						self.affine_transformation(name_pep2,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1),[0,-self.unit.b1,0],[0,y*(2*i+1),0])
-					z_sign2 = np.sign(pos_z+self.unit.d/2.0)*sign
-					for i in range(num_half):
-						name = str(i)+'_'+str(idx_unit)
-						name_pep1,name_pep2 = 'snr_s2_pep1_'+name,'snr_s2_pep2_'+name
-						pymol.cmd.create(name_pep1,'s2_pep1')
-						pymol.cmd.translate([pos_x,0,pos_z],name_pep1)
-						self.affine_transformation(name_pep1,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i,[0,0,0],[0,y*2*i,0])
-						pymol.cmd.create(name_pep2,'s2_pep2')
-						pymol.cmd.translate([pos_x,0,pos_z],name_pep2)
-						self.affine_transformation(name_pep2,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1),[0,-self.unit.b2,0],[0,y*(2*i+1),0])
-					for i in range(num_half):
-						name_box = 'vis_'+str(i)+'_'+str(idx_unit)
-						self.affine_transformation_a_box(name_box,0,y_sign*theta_y*(2*i+0.5),[pos_x,0,pos_z],[0,y*2*i,0])
-					idx_unit += 1
-			pymol.cmd.color('green','snr_s1_*')
-			pymol.cmd.color('orange','snr_s2_*')
-			pymol.cmd.group('s_rod','snr_*')
-			pymol.cmd.group('visBox','vis_*')
+			def place_layers(i,lo_stack):
+				# Every layer of every unit at once
+				layer,idx_unit,pos = self.get_lattice(i,lo_position)
+				y_sign = -sign
+				z_sign1 = np.sign(pos[:,2]-self.unit.d/2.0)*sign
+				# Build the structure
+				self.place('s1_pep1',layer,idx_unit,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*layer,pos,along_y(y*2*layer))
+				self.place('s1_pep2',layer,idx_unit,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*layer+1),pos,along_y(y*(2*layer+1)))
+				z_sign2 = np.sign(pos[:,2]+self.unit.d/2.0)*sign
+				self.place('s2_pep1',layer,idx_unit,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*layer,pos,along_y(y*2*layer))
+				self.place('s2_pep2',layer,idx_unit,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*layer+1),pos,along_y(y*(2*layer+1)))
+				self.place_box(0,y_sign*theta_y*(2*layer+0.5),pos,along_y(y*2*layer))
+			self.set_layout(place_layers,'snr_','s_rod',1,num_half)
 			self.set_dimension(max(radius_matrix.reshape(-1)),theta_z,theta_y,y)
-			return
+			return self.get_model()
 
+	@monitored_build
 	def build_a_ribbon(self,angle_z,radius,num_half,sign):
 		radius_offset = self.unit.d/2.0
 		# Refine the input geometry
 		param = self.refine_theta_radius(angle_z*np.pi/180,radius,sign)
 		if param == None:
-			print ('Please decrease tilt angle or try another radius!')
-			print ('Stop to update ... ')
+			self.report('Please decrease tilt angle or try another radius!')
+			self.report('Stop to update ... ')
 			return
 		else:
 			theta_z,theta_y,radius,y = param
 			angle_z,angle_y = theta_z*180/np.pi,theta_y*180/np.pi
-			y_sign = -sign
-			# Build the structure
-			z_sign1 = np.sign(radius-self.unit.d/2.0)*sign
-			for i in range(num_half):
-				name_pep1,name_pep2 = 'r_s1_pep1_'+str(i),'r_s1_pep2_'+str(i)
-				pymol.cmd.create(name_pep1,'s1_pep1')
-				pymol.cmd.translate([0,0,radius],name_pep1)
-				self.affine_transformation(name_pep1,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i,[0,0,0],[0,y*2*i,0])
-				pymol.cmd.create(name_pep2,'s1_pep2')
-				pymol.cmd.translate([0,0,radius],name_pep2)
-				self.affine_transformation(name_pep2,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1),[0,-self.unit.b1,0],[0,y*(2*i+1),0])
-			z_sign2 = np.sign(radius+self.unit.d/2.0)*sign
-			for i in range(num_half):
-				name_pep1,name_pep2 = 'r_s2_pep1_'+str(i),'r_s2_pep2_'+str(i)
-				pymol.cmd.create(name_pep1,'s2_pep1')
-				pymol.cmd.translate([0,0,radius],name_pep1)
-				self.affine_transformation(name_pep1,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i,[0,0,0],[0,y*2*i,0])
-				pymol.cmd.create(name_pep2,'s2_pep2')
-				pymol.cmd.translate([0,0,radius],name_pep2)
-				self.affine_transformation(name_pep2,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1),[0,-self.unit.b2,0],[0,y*(2*i+1),0])
-			tilt_s1,tilt_s2 = self.tilt_s1*np.pi/180,self.tilt_s2*np.pi/180
-			for i in range(num_half):
-				name_box = 'vis_'+str(i)
-				self.affine_transformation_a_box(name_box,(z_sign1/2.0+z_sign2/2.0)*(theta_z+tilt_s1/2.0+tilt_s2/2.0),y_sign*theta_y*(2*i+0.5),[0,0,radius],[0,y*2*i,0])
-
-			pymol.cmd.color('green','r_s1_*')
-			pymol.cmd.color('orange','r_s2_*')
-			pymol.cmd.group('a_ribbon','r_*')
-			pymol.cmd.group('visBox','vis_*')
+			def place_layers(i,lo_stack):
+				y_sign = -sign
+				# Build the structure
+				z_sign1 = np.sign(radius-self.unit.d/2.0)*sign
+				self.place('s1_pep1',i,0,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i,[0,0,radius],along_y(y*2*i))
+				self.place('s1_pep2',i,0,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1),[0,0,radius],along_y(y*(2*i+1)))
+				z_sign2 = np.sign(radius+self.unit.d/2.0)*sign
+				self.place('s2_pep1',i,0,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i,[0,0,radius],along_y(y*2*i))
+				self.place('s2_pep2',i,0,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1),[0,0,radius],along_y(y*(2*i+1)))
+				tilt_s1,tilt_s2 = self.tilt_s1*np.pi/180,self.tilt_s2*np.pi/180
+				self.place_box((z_sign1/2.0+z_sign2/2.0)*(theta_z+tilt_s1/2.0+tilt_s2/2.0),y_sign*theta_y*(2*i+0.5),[0,0,radius],along_y(y*2*i))
+			self.set_layout(place_layers,'r_','a_ribbon',0,num_half)
 			self.set_dimension(radius,theta_z,theta_y,y)
-			return
+			return self.get_model()
 
+	@monitored_build
 	def build_a_stacked_ribbon(self,angle_z,radius,angle_stack,num_stack,num_half,sign):
 		radius_offset = self.unit.d/2.0
 		# Refine the input geometry
 		param = self.refine_stack_ribbon(angle_z*np.pi/180,radius,sign,angle_stack*np.pi/180,num_stack)
 		if param == None:
-			print ('Please decrease tilt angle, try another radius, or try another stack angle!')
-			print ('Stop to update ... ')
+			self.report('Please decrease tilt angle, try another radius, or try another stack angle!')
+			self.report('Stop to update ... ')
 			return		
 		else:
-			theta_z,theta_y,radius,y = param
+			theta_z,theta_y,radius,y = param[:4]
 			angle_z,angle_y = theta_z*180/np.pi,theta_y*180/np.pi
-			y_sign = -sign
-			# Stacking
-			for j in range(num_stack):
-				# Build the structure
-				z_sign1 = np.sign(radius-self.unit.d/2.0)*sign
-				for i in range(num_half):
-					name = str(i)+'_'+str(j)
-					name_pep1,name_pep2 = 'sr_s1_pep1_'+name,'sr_s1_pep2_'+name
-					pymol.cmd.create(name_pep1,'s1_pep1')
-					pymol.cmd.translate([0,0,radius],name_pep1)
-					self.affine_transformation(name_pep1,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i-angle_stack*j,[0,0,0],[0,y*2*i,0])
-					pymol.cmd.create(name_pep2,'s1_pep2')
-					pymol.cmd.translate([0,0,radius],name_pep2)
-					self.affine_transformation(name_pep2,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1)-angle_stack*j,[0,-self.unit.b1,0],[0,y*(2*i+1),0])
-				z_sign2 = np.sign(radius+self.unit.d/2.0)*sign
-				for i in range(num_half):
-					name = str(i)+'_'+str(j)
-					name_pep1,name_pep2 = 'sr_s2_pep1_'+name,'sr_s2_pep2_'+name
-					pymol.cmd.create(name_pep1,'s2_pep1')
-					pymol.cmd.translate([0,0,radius],name_pep1)
-					self.affine_transformation(name_pep1,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i-angle_stack*j,[0,0,0],[0,y*2*i,0])
-					pymol.cmd.create(name_pep2,'s2_pep2')
-					pymol.cmd.translate([0,0,radius],name_pep2)
-					self.affine_transformation(name_pep2,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1)-angle_stack*j,[0,-self.unit.b2,0],[0,y*(2*i+1),0])
-				tilt_s1,tilt_s2,theta_stack = self.tilt_s1*np.pi/180,self.tilt_s2*np.pi/180,angle_stack*np.pi/180
-				for i in range(num_half):
-					name_box = 'vis_'+str(i)+'_'+str(j)
-					self.affine_transformation_a_box(name_box,(z_sign1/2.0+z_sign2/2.0)*(theta_z+tilt_s1/2.0+tilt_s2/2.0),y_sign*theta_y*(2*i+0.5)-theta_stack*j,[0,0,radius],[0,y*2*i,0])
-			pymol.cmd.color('green','sr_s1_*')
-			pymol.cmd.color('orange','sr_s2_*')
-			pymol.cmd.group('s_ribbon','sr_*')
-			pymol.cmd.group('visBox','vis_*')
+			def place_layers(i,lo_stack):
+				y_sign = -sign
+				# Stacking
+				for j in lo_stack:
+					# Build the structure
+					z_sign1 = np.sign(radius-self.unit.d/2.0)*sign
+					self.place('s1_pep1',i,j,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*2*i-angle_stack*j,[0,0,radius],along_y(y*2*i))
+					self.place('s1_pep2',i,j,z_sign1*(angle_z+self.tilt_s1),y_sign*angle_y*(2*i+1)-angle_stack*j,[0,0,radius],along_y(y*(2*i+1)))
+					z_sign2 = np.sign(radius+self.unit.d/2.0)*sign
+					self.place('s2_pep1',i,j,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*2*i-angle_stack*j,[0,0,radius],along_y(y*2*i))
+					self.place('s2_pep2',i,j,z_sign2*(angle_z+self.tilt_s2),y_sign*angle_y*(2*i+1)-angle_stack*j,[0,0,radius],along_y(y*(2*i+1)))
+					tilt_s1,tilt_s2,theta_stack = self.tilt_s1*np.pi/180,self.tilt_s2*np.pi/180,angle_stack*np.pi/180
+					self.place_box((z_sign1/2.0+z_sign2/2.0)*(theta_z+tilt_s1/2.0+tilt_s2/2.0),y_sign*theta_y*(2*i+0.5)-theta_stack*j,[0,0,radius],along_y(y*2*i))
+			self.set_layout(place_layers,'sr_','s_ribbon',1,num_half,num_stack,angle_stack*np.pi/180)
 			self.set_dimension(radius,theta_z,theta_y,y)
+			return self.get_model()
+
+	def set_layout(self,place_layers,prefix,group,stacked,num_half,num_stack=1,theta_stack=None):
+		# Keep the placement of a new build (refined parameters included) so that layers or stacks can be added later
+		self.copies,self.boxes,self.raw_coords = [],[],[]
+		self.layout = {'place':place_layers,'prefix':prefix,'group':group,'stacked':stacked,\
+						'first':0,'last':num_half,'num_stack':num_stack,'theta_stack':theta_stack}
+		self.grow(np.arange(num_half),range(num_stack))
+
+	@monitored_build
+	def extend(self,num_layer,prepend=0):
+		# Add layers (units per sheet) after the last one, or before the first one, of the last build without refining it again
+		layout = self.layout
+		if layout == None:
+			self.report('Please build a fibril first!')
+			return
+		if self.mode == 'frames':
+			self.report('Frames share the peptide copies of the first frame, please build again instead!')
+			return
+		if prepend:
+			i = np.arange(layout['first']-num_layer,layout['first'])
+			layout['first'] -= num_layer
+		else:
+			i = np.arange(layout['last'],layout['last']+num_layer)
+			layout['last'] += num_layer
+		self.grow(i,range(layout['num_stack']),prepend)
+		return self.get_model()
+
+	@monitored_build
+	def extend_stack(self,num_stack):
+		# Add stacks to the last stacked ribbon without refining it again
+		layout = self.layout
+		if (layout == None) or (layout['theta_stack'] == None):
+			self.report('Only a stacked ribbon can be extended by stacks!')
+			return
+		if self.mode == 'frames':
+			self.report('Frames share the peptide copies of the first frame, please build again instead!')
+			return
+		if (layout['num_stack']+num_stack)*layout['theta_stack'] > 2*np.pi:
+			self.report('Please decrease the number of stacks!')
+			return
+		j = range(layout['num_stack'],layout['num_stack']+num_stack)
+		layout['num_stack'] += num_stack
+		self.grow(np.arange(layout['first'],layout['last']),j)
+		return self.get_model()
+
+	def grow(self,i,lo_stack,prepend=0):
+		# Place layers i of stacks lo_stack (before the first layer, if prepend) and emit only these copies
+		start = sum([len(c['pep']) for c in self.copies])
+		self.layout['place'](i,lo_stack)
+		self.emit(self.layout['prefix'],self.layout['group'],self.layout['stacked'],start,prepend)
+
+	def get_position_matrix(self,stacking,angle_z):
+		# Positions (z,x) of the units on the cross-section for a tilt angle
+		stack_z,stack_x = np.array(stacking).shape
+		started_z,started_x = (stack_z-1)/2.0,(stack_x-1)/2.0
+		theta_z = angle_z*np.pi/180
+		dist_z = self.unit.box_w
+		dist_x = self.unit.box_l*np.cos(theta_z)+self.unit.b*np.sin(theta_z)
+		j,k = np.meshgrid(np.arange(stack_z),np.arange(stack_x),indexing='ij')
+		return np.stack([(started_z-j)*dist_z,(-started_x+k)*dist_x],axis=2).astype(float)
+
+	def get_lattice(self,i,lo_position):
+		# Rows for layers i of every unit (pos_z,pos_x): layer, unit index and translation [pos_x,0,pos_z]
+		idx_unit = np.repeat(np.arange(len(lo_position)),len(i))
+		layer = np.tile(i,len(lo_position))
+		pos = np.zeros((len(layer),3))
+		if len(layer):
+			pos[:,0],pos[:,2] = np.array(lo_position)[idx_unit,1],np.array(lo_position)[idx_unit,0]
+		return layer,idx_unit,pos
+
+	def get_unique_radii(self,lo_radius):
+		# One radius for each group of units that are equivalent by the symmetry of the cross-section, innermost first
+		lo_radius = np.array(lo_radius,dtype=float).reshape(-1)
+		return lo_radius[np.unique(np.round(lo_radius,6),return_index=True)[1]]
+
+	def place(self,pep,layer,stack,angle_z,angle_y,translation1,translation2,center=1):
+		# Append copies of a template peptide to the copy table (one row per layer)
+		layer = np.atleast_1d(layer)
+		n = len(layer)
+		self.copies += [{'pep':np.full(n,PEP_NAMES.index(pep)),'layer':layer,'stack':np.full(n,stack),\
+					'angle_z':np.broadcast_to(np.array(angle_z,dtype=float),(n,)),'angle_y':np.broadcast_to(np.array(angle_y,dtype=float),(n,)),\
+					'translation1':np.broadcast_to(np.array(translation1,dtype=float),(n,3)),'translation2':np.broadcast_to(np.array(translation2,dtype=float),(n,3)),\
+					'center':np.full(n,center)}]
+
+	def place_box(self,theta_z,theta_y,translation1,translation2):
+		# Append bounding boxes of units (angles in radian)
+		translation2 = np.array(translation2,dtype=float).reshape((-1,3))
+		n = len(translation2)
+		self.boxes += [{'theta_z':np.broadcast_to(np.array(theta_z,dtype=float),(n,)),'theta_y':np.broadcast_to(np.array(theta_y,dtype=float),(n,)),\
+					'translation1':np.broadcast_to(np.array(translation1,dtype=float),(n,3)),'translation2':translation2}]
+
+	def emit_boxes(self):
+		# Transform the vertices of all boxes in one pass and draw them as one CGO object
+		if (self.mode not in ['merged','visual']) or (self.box_detail == 'none') or (len(self.boxes) == 0):
 			return
+		boxes = dict([(key,np.concatenate([c[key] for c in self.boxes])) for key in self.boxes[0]])
+		vertices = transform_points(get_bounding_vertices(self.unit.box_boundaries),boxes['theta_z']*180/np.pi,boxes['theta_y']*180/np.pi,\
+					boxes['translation1'],boxes['translation2'])
+		pymol.cmd.delete(self.get_name('visBox'))
+		draw_boxes(vertices,self.get_name('visBox'),self.box_detail)
+
+	def get_model(self):
+		# Compact model of the last build (float32 coordinates, copy indices, shared template atoms); in modes that keep no coordinates they are computed on demand
+		coords = self.coords if len(self.raw_coords) == len(self.table['pep']) else None
+		dimension = dict([(key,getattr(self,key)) for key in ['radius','angle_z','angle_y','pitch','period']])
+		return fibril_model(self.unit.templates,self.table,coords,dimension)
+
+	def get_table(self):
+		# Concatenate the copy table in placement order, and the order by stack, sheet, layer and peptide
+		table = dict([(key,np.concatenate([c[key] for c in self.copies])) for key in self.copies[0]])
+		order = np.lexsort((table['pep'],table['layer'],table['pep']//2,table['stack']))
+		return table,order
+
+	def emit(self,prefix,group,stacked=0,start=0,prepend=0):
+		# Emit the copies placed from row start on (earlier rows were emitted by the previous calls), which come first in their chains if prepend
+		prefix,group = self.get_name(prefix),self.get_name(group)
+		rows,order = self.get_table()
+		self.table = dict([(key,value[order]) for (key,value) in rows.items()])
+		new = dict([(key,value[start:]) for (key,value) in rows.items()])
+		with self.phase('output'):
+			self.emit_boxes()
+		if self.mode == 'visual':
+			# One PyMOL object per peptide, transformed in NumPy
+			with self.phase('output'):
+				for (k,record) in enumerate(self.iter_copies(None,new)):
+					pep = PEP_NAMES[new['pep'][k]]
+					layer = new['layer'][k]
+					name = prefix+pep+'_'+(str(layer) if layer >= 0 else 'm'+str(-layer))
+					if stacked:
+						name += '_'+str(new['stack'][k])
+					pymol.cmd.delete(name)
+					pymol.cmd.read_pdbstr(''.join(iter_lines([record],'pdb',name)),name)
+				pymol.cmd.color('green',prefix+'s1_*')
+				pymol.cmd.color('orange',prefix+'s2_*')
+				pymol.cmd.group(group,prefix+'*')
+			return
+		if self.mode == 'file':
+			# Stream to a file without holding the coordinates
+			with self.phase('output'):
+				self.write_file(self.root_out or group+'.pdb',new,start,prepend)
+			return
+		# One batched transformation per template peptide, for the rows without coordinates
+		with self.phase('transform'):
+			done = len(self.raw_coords)
+			coords = [None]*(len(rows['pep'])-done)
+			for (p,pep) in enumerate(PEP_NAMES):
+				idx = np.where(rows['pep'][done:] == p)[0]
+				if len(idx):
+					lo_coord = transform_copies(self.unit.templates[pep],rows['angle_z'][done+idx],rows['angle_y'][done+idx],\
+								rows['translation1'][done+idx],rows['translation2'][done+idx],rows['center'][done+idx])
+					for (k,coord) in zip(idx,lo_coord):
+						coords[k] = coord
+			self.raw_coords += coords
+			self.coords = [self.raw_coords[k] for k in order]
+		if self.mode == 'frames':
+			with self.phase('output'):
+				self.add_frame()
+		if self.mode == 'merged':
+			# Load a single merged object, or add the new copies to it
+			with self.phase('output'):
+				fmt = get_format(group+'.pdb',*self.get_size())
+				if start == 0:
+					self.emitted = {'atom':1,'lo_resi':{}}
+					name = group
+				else:
+					name = group+'_new'
+				# Prepended copies are numbered from 1, and the copies loaded before them are renumbered after them
+				state = {'atom':1,'lo_resi':{}} if prepend else self.emitted
+				order_new = np.lexsort((new['pep'],new['layer'],new['pep']//2,new['stack']))
+				records = self.iter_copies([self.raw_coords[start+k] for k in order_new],dict([(key,value[order_new]) for (key,value) in new.items()]))
+				text = ''.join(iter_lines(records,fmt,group,state))
+				pymol.cmd.delete(name)
+				if fmt == 'pdb':
+					pymol.cmd.read_pdbstr(text,name)
+				else:
+					pymol.cmd.load_raw(text,'cif',name)
+				idx_chain = np.unique(2*new['stack']+new['pep']//2)
+				for (color,lo_chain) in [('green',[c for c in idx_chain if c%2 == 0]),('orange',[c for c in idx_chain if c%2 == 1])]:
+					if len(lo_chain):
+						pymol.cmd.color(color,name+' and chain '+'+'.join([get_chain_id(c) for c in lo_chain]))
+				if prepend:
+					shift = dict([(chain,resi-1) for (chain,resi) in state['lo_resi'].items()])
+					pymol.cmd.alter(group,'(resv,ID) = (resv+shift.get(chain,0),ID+num_atoms)',space={'shift':shift,'num_atoms':state['atom']-1})
+					for (chain,num) in shift.items():
+						self.emitted['lo_resi'][chain] = self.emitted['lo_resi'].get(chain,1)+num
+					self.emitted['atom'] += state['atom']-1
+				if start:
+					pymol.cmd.copy_to(group,name,rename='')
+					pymol.cmd.delete(name)
+		return
+
+	def write_file(self,root_out,new,start=0,prepend=0):
+		# Write the last build to root_out; the copies of an extension are appended to the file, except prepended ones (which come first
+		# in their chains) or a change to mmCIF beyond the PDB limits, for which the whole file is written again
+		fmt = get_format(root_out,*self.get_size())
+		if (fmt == 'cif') and not root_out.lower().endswith(('.cif','.mmcif')):
+			root_out = os.path.splitext(root_out)[0]+'.cif'
+		name = os.path.splitext(os.path.basename(root_out))[0]
+		if (not start) or prepend or (getattr(self,'emitted',{}).get('root_out') != root_out):
+			self.emitted = {'atom':1,'lo_resi':{},'root_out':root_out}
+			with open(root_out,'w') as f:
+				for text in iter_lines(self.iter_copies(),fmt,name,self.emitted):
+					f.write(text)
+			return root_out
+		order_new = np.lexsort((new['pep'],new['layer'],new['pep']//2,new['stack']))
+		tail = ('#\n' if fmt == 'cif' else 'END\n').encode()
+		with open(root_out,'r+b') as f:
+			f.seek(-len(tail),2)
+			f.truncate()
+			for text in iter_lines(self.iter_copies(None,dict([(key,value[order_new]) for (key,value) in new.items()])),fmt,name,self.emitted,header=0):
+				f.write(text.encode())
+		return root_out
+
+	def add_frame(self):
+		# Append the last build to root_out as a frame; all frames of a file share the copies (num_half and stacking) of the first one
+		root_out = self.root_out or 'frames.dcd'
+		topology = np.stack([self.table['pep'],self.table['layer'],self.table['stack']])
+		if (self.frames == None) or (self.frames.root_out != root_out):
+			self.frames = frame_writer(root_out,os.path.splitext(os.path.basename(root_out))[0])
+			self.frame_topology = topology
+		elif not np.array_equal(topology,self.frame_topology):
+			raise ValueError('A frame must have the peptide copies of the first frame of '+root_out)
+		self.frames.add(np.concatenate(self.coords),self.iter_copies(self.coords))
+
+	def iter_copies(self,coords=None,table=None):
+		# Yield (template, coordinates, chain index, segment) one peptide copy at a time
+		if table == None:
+			table = self.table
+		for k in range(len(table['pep'])):
+			pep = PEP_NAMES[table['pep'][k]]
+			template = self.unit.templates[pep]
+			if coords is None:
+				coord = transform_copies(template,table['angle_z'][k],table['angle_y'][k],\
+							table['translation1'][k],table['translation2'][k],table['center'][k])[0]
+			else:
+				coord = coords[k]
+			yield template,coord,2*table['stack'][k]+table['pep'][k]//2,pep[:2].upper()
+
+	def get_size(self):
+		# Number of atoms, the largest number of residues in a chain, and number of chains of the last build
+		table = self.table
+		num_atoms = np.array([len(self.unit.templates[pep]) for pep in PEP_NAMES])
+		num_residues = np.array([self.unit.templates[pep].residue[-1]+1 for pep in PEP_NAMES])
+		idx_chain = 2*table['stack']+table['pep']//2
+		lo_residues = np.bincount(idx_chain,weights=num_residues[table['pep']])
+		return int(np.sum(num_atoms[table['pep']])),int(np.max(lo_residues)),int(np.max(idx_chain))+1
+
+	@monitored_phase('output')
+	def save(self,root_out):
+		# Write the last build to PDB (or mmCIF beyond the PDB limits), one copy at a time
+		fmt = get_format(root_out,*self.get_size())
+		if (fmt == 'cif') and not root_out.lower().endswith(('.cif','.mmcif')):
+			root_out = os.path.splitext(root_out)[0]+'.cif'
+		return write_structure(root_out,self.iter_copies(),fmt,os.path.splitext(os.path.basename(root_out))[0])
 
 
 	def set_dimension(self,radius,theta_z,theta_y,y):
@@ -524,18 +862,53 @@ class create_fibril():
 		return
 
 	def get_dimension(self):
-		print ('Radius: '+str(self.radius/10.0)+' nm')
+		self.report('Radius: '+str(self.radius/10.0)+' nm')
 		if self.period != float('inf'):
-			print ('Pitch length: '+str(self.pitch/10)+' nm')
-		print ('Tilt angle: '+str(self.angle_z)+' degree')
-		print ('Twist angle: '+str(self.angle_y)+' degree')
-		print ('Period: '+str(self.period)+' peptides')
+			self.report('Pitch length: '+str(self.pitch/10)+' nm')
+		self.report('Tilt angle: '+str(self.angle_z)+' degree')
+		self.report('Twist angle: '+str(self.angle_y)+' degree')
+		self.report('Period: '+str(self.period)+' peptides')
 		return
 
 
+	def get_refine_state(self):
+		# Settings other than the unit and call arguments that change a refinement
+		state = [self.tilt_s1,self.tilt_s2,self.dist_tolorence,self.twist_limit,self.twist_tolorence]
+		if self.refine_iterations != 40:
+			state += [self.refine_iterations]
+		if self.resolution != 'atom':
+			state += [self.resolution,self.bead_tolorence[self.resolution],self.verify]
+		return state
+
+	def check_refinement(self,name,args,value):
+		# The clash test of a refine_* method at the parameters it returned
+		if name in ['refine_theta','refine_stack_rod']:
+			theta_z,theta_y = value[:2]
+		else:
+			theta_z,theta_y,radius = value[:3]
+		sign = args[2]
+		if name == 'refine_theta':
+			return self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[np.sign(-self.unit.d/2.0)*sign,np.sign(self.unit.d/2.0)*sign],sign,0)
+		elif name == 'refine_theta_radius':
+			return self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[sign,sign],sign,radius)
+		elif name == 'refine_stack_rod':
+			for a_radius in self.get_unique_radii(args[1]):
+				if not self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[np.sign(-self.unit.d/2.0)*sign,np.sign(self.unit.d/2.0)*sign],sign,a_radius):
+					return 0
+			if (len(args) > 3) and (args[3] != None):
+				return self.units_are_not_clashed(theta_z*180/np.pi,theta_y*180/np.pi,sign,args[3])
+			return 1
+		elif name == 'refine_stack_ribbon':
+			return self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[sign,sign],sign,radius,args[3]*180/np.pi)
+		raise ValueError('Unknown refinement: '+name)
+
+	@monitored_phase('refine')
+	@cached_refinement
+	@verified_refinement
 	def refine_theta(self,theta_z,radius,sign):
 		# Refine the structure by 40 iterations
-		for i in range(40):
+		for i in range(self.refine_iterations):
+			self.count('iterations')
 			# Calculate the twist angle
 			k = self.unit.b*np.sin(theta_z)
 			theta_y = np.arccos(1-0.5*(k/radius)**2)
@@ -551,9 +924,13 @@ class create_fibril():
 		self.set_dimension(radius,theta_z,theta_y,y)
 		return None
 
+	@monitored_phase('refine')
+	@cached_refinement
+	@verified_refinement
 	def refine_theta_radius(self,theta_z,radius,sign):
 		# Refine the structure by 40 iterations
-		for i in range(40):
+		for i in range(self.refine_iterations):
+			self.count('iterations')
 			# Calculate the twist angle
 			k = self.unit.b*np.sin(theta_z)
 			theta_y = np.arccos(1-0.5*(k/radius)**2)
@@ -570,17 +947,26 @@ class create_fibril():
 		return None
 
 
-	def refine_stack_rod(self,theta_z,lo_radius,sign):
+	@monitored_phase('refine')
+	@cached_refinement
+	@verified_refinement
+	def refine_stack_rod(self,theta_z,lo_radius,sign,lo_position=None):
 		# Refine the structure by 40 iterations
 		radius = min(lo_radius)	# check from the outermost sheet
-		for i in range(40):
+		for i in range(self.refine_iterations):
+			self.count('iterations')
 			k = self.unit.b*np.sin(theta_z)
 			theta_y = np.arccos(1-0.5*(k/radius)**2)
 			y = self.unit.b*np.cos(theta_z)
-			# Check clashes
+			# Check clashes, once per radius and stopping at the first clash
 			good_unit = 1
-			for a_radius in lo_radius:
-				good_unit *= self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[np.sign(-self.unit.d/2.0)*sign,np.sign(self.unit.d/2.0)*sign],sign,a_radius)
+			for a_radius in self.get_unique_radii(lo_radius):
+				good_unit = self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[np.sign(-self.unit.d/2.0)*sign,np.sign(self.unit.d/2.0)*sign],sign,a_radius)
+				if not good_unit:
+					break
+			# Check clashes between neighbor units
+			if good_unit and (lo_position != None):
+				good_unit *= self.units_are_not_clashed(theta_z*180/np.pi,theta_y*180/np.pi,sign,lo_position)
 			if good_unit:
 				return [theta_z,theta_y,y]
 			else:
@@ -589,81 +975,28 @@ class create_fibril():
 		self.set_dimension(radius,theta_z,theta_y,y)
 		return None
 
+	@monitored_phase('refine')
+	@cached_refinement
+	@verified_refinement
 	def refine_stack_ribbon(self,theta_z,radius,sign,theta_stack,num_stack):
-		def edge_contact(radius,theta_z,theta_y,y,theta_stack,num_stack):
-			edge = (radius**2+(self.unit.l*np.cos(theta_z)/2.0)**2)**0.5
-			theta_shift = 2*np.arcsin(self.unit.l*np.cos(theta_z)/(2*edge))
-			# Check intersection on the cross-section
-			if (theta_stack < theta_shift) or (num_stack*theta_stack > 2*np.pi):
-				return 'too_close'
-			else:
-				# Check whether peptides from neighbor sheets intersect
-				y_shift = self.unit.l*np.sin(theta_z)/2.0
-				pos_edge1 = np.array([np.cos(theta_stack)*edge,y_shift,np.sin(theta_stack)*edge])
-				lo_contact = []
-				for i in range(int(2*np.pi/theta_y)):
-					pos_edge2 = np.array([np.cos(theta_shift+theta_y*i)*edge,-y_shift+y*i,np.sin(theta_shift+theta_y*i)*edge])
-					contact = np.linalg.norm(pos_edge1-pos_edge2)
-					if (1 < contact):
-						lo_contact += [contact]
-						continue
-					else:
-						return 'too_close'
-				# Check whether existing peptides from neighbor sheets are in close contact
-				if min(lo_contact) < 4:
-					# print ('contact',lo_contact)
-					return 'good_dist'
-				else:
-					return 'too_far'
-
-		# Refine the structure by 40 iterations
-		for i in range(40):
-			# Calculate the twist angle
-			k = self.unit.b*np.sin(theta_z)
-			theta_y = np.arccos(1-0.5*(k/radius)**2)
-			y = self.unit.b*np.cos(theta_z)
-			# Check clashes
-			good_unit = self.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[sign,sign],sign,radius)
-			contact = edge_contact(radius-self.unit.d/2.0,theta_z,theta_y,y,theta_stack,num_stack)
-			if (good_unit and contact=='good_dist'):
-				return [theta_z,theta_y,radius,y]
-			elif (not good_unit and contact=='too_close'):
-				radius += 1
-				if theta_z > 0.02:
-					theta_z -= 0.02
-			elif (good_unit and contact=='too_far'):
-				radius -= 1
-				theta_z += 0.02
-			else:
-				radius += (np.random.randint(3)-1)
-		self.set_dimension(radius,theta_z,theta_y,y)
+		# Search (theta_z, radius) within refine_iterations steps (0.02 rad, 1 A) of the input, the nearest and then the most compact configuration first.
+		# The cross-section test (neighbor stacks in close contact without intersecting) screens the whole grid at once,
+		# and at most refine_iterations of its survivors are checked for clashes. Returns [theta_z, theta_y, radius, y] (see refine_evaluations for the clash tests)
+		if num_stack*theta_stack > 2*np.pi:
+			return None
+		num_step = self.refine_iterations
+		step_z,step_r = np.meshgrid(np.arange(-num_step,num_step+1),np.arange(-num_step,num_step+1),indexing='ij')
+		grid_z,grid_r = (theta_z+0.02*step_z).reshape(-1),(radius+step_r).reshape(-1)
+		grid_y,grid_rise = get_twist(self.unit.b,grid_z,grid_r)
+		contact = get_edge_contact(self.unit.l,grid_r-self.unit.d/2.0,grid_z,grid_y,grid_rise,theta_stack,num_stack)
+		with np.errstate(invalid='ignore'):
+			good_edge = (grid_z > 0)&(grid_z < np.pi/2)&(grid_r > self.unit.d/2.0)&(grid_y*180/np.pi < self.twist_limit)&\
+						(contact == EDGE_CONTACT.index('good_dist'))
+		idx = np.where(good_edge)[0]
+		order = idx[np.lexsort((-grid_z[idx],grid_r[idx],np.abs(step_z).reshape(-1)[idx]+np.abs(step_r).reshape(-1)[idx]))]
+		for k in order[:num_step]:
+			self.count('iterations')
+			good_unit = self.check_unit(grid_z[k]*180/np.pi,grid_y[k]*180/np.pi,[sign,sign],sign,grid_r[k],theta_stack*180/np.pi)
+			if good_unit:
+				return [float(grid_z[k]),float(grid_y[k]),float(grid_r[k]),float(grid_rise[k])]
 		return None
-
-	def affine_transformation_a_box(self,name,theta_z,theta_y,translation1,translation2):
-		vertices = np.array(get_bounding_vertices(self.unit.box_boundaries))
-		coord = (vertices+np.array(translation1).reshape((-1,3))).T
-		c,s = np.cos(theta_z),np.sin(theta_z)
-		matrix_z = np.array([[c,-s,0],[s,c,0],[0,0,1]])
-		coord = np.dot(matrix_z,coord)
-		c,s = np.cos(theta_y),np.sin(theta_y)
-		matrix_y = np.array([[c,0,s],[0,1,0],[-s,0,c]])
-		coord = np.dot(matrix_y,coord)
-		coord = coord.T+np.array(translation2).reshape((-1,3))
-		draw_box(coord.tolist(),name)
-
-	def affine_transformation(self,name,angle_z,angle_y,translation1,translation2):
-		# pymol.cmd.translate(translation1,name)
-		y = np.mean(get_ca(name),0)[1]
-		pymol.cmd.translate([0,-y,0],name)
-		pymol.cmd.rotate('z',angle_z,name,-1,1,None,[0,0,0])
-		pymol.cmd.rotate('y',angle_y,name,-1,1,None,[0,0,0])
-		pymol.cmd.translate(translation2,name)
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,135 @@
+# On-disk cache of refinement results for builder.py
+
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+def get_unit_hash(unit):
+	# Content address of a sheet unit: its dimensions and the coordinates of the four template peptides
+	h = hashlib.sha256()
+	h.update(json.dumps(to_json([unit.b1,unit.b2,unit.b,unit.d,unit.l,unit.box_boundaries])).encode())
+	for name in sorted(unit.templates):
+		h.update(name.encode())
+		h.update(np.ascontiguousarray(unit.templates[name].coords,dtype=np.float64).tobytes())
+	return h.hexdigest()
+
+def to_json(value):
+	if isinstance(value,(list,tuple,np.ndarray)):
+		return [to_json(v) for v in value]
+	elif isinstance(value,(np.integer,int)) and not isinstance(value,bool):
+		return int(value)
+	elif isinstance(value,(np.floating,float)):
+		return float(value)
+	return value
+
+class refine_cache():
+	# INPUT (cache directory, size cap in bytes of allocated disk blocks)
+	def __init__(self,root,max_size=64*2**20):
+		self.root = root
+		self.max_size = max_size
+		self.hits,self.misses = 0,0
+		# Running size of the cache, from one scan of the directory on the first write (None before)
+		self.size = None
+
+	def get_key(self,*parts):
+		return hashlib.sha256(json.dumps(to_json(list(parts))).encode()).hexdigest()
+
+	def get_path(self,key):
+		return os.path.join(self.root,key[:2],key+'.json')
+
+	def get(self,key):
+		# Return (found, value); a hit refreshes the entry for LRU eviction
+		path = self.get_path(key)
+		try:
+			with open(path) as f:
+				value = json.load(f)['value']
+			os.utime(path)
+		except (OSError,ValueError,KeyError):
+			self.misses += 1
+			return False,None
+		self.hits += 1
+		return True,value
+
+	def set(self,key,value):
+		path = self.get_path(key)
+		os.makedirs(os.path.dirname(path),exist_ok=True)
+		if self.size == None:
+			self.size = sum([size for (mtime,size,path_entry) in self.scan()])
+		# A unique temporary file per writer (process or thread), renamed into place
+		fd,path_tmp = tempfile.mkstemp(suffix='.tmp',dir=os.path.dirname(path))
+		with os.fdopen(fd,'w') as f:
+			json.dump({'value':to_json(value)},f)
+		try:
+			self.size -= get_disk_size(os.stat(path))
+		except OSError:
+			pass
+		os.replace(path_tmp,path)
+		self.size += get_disk_size(os.stat(path))
+		# Other writers are only seen by a scan, done once the running size is over the cap
+		if self.size > self.max_size:
+			self.evict()
+
+	def scan(self):
+		# (mtime, size, path) of every entry
+		acc = []
+		for (dirpath,dirnames,filenames) in os.walk(self.root):
+			for name in filenames:
+				if name.endswith('.json'):
+					path = os.path.join(dirpath,name)
+					try:
+						stat = os.stat(path)
+					except OSError:
+						continue
+					acc += [(stat.st_mtime,get_disk_size(stat),path)]
+		return acc
+
+	def evict(self,max_size=None):
+		# Remove the least recently used entries until the cache fits in 3/4 of max_size, so that the next scan is many writes away
+		if max_size == None:
+			max_size = 0.75*self.max_size
+		acc = self.scan()
+		total = sum([size for (mtime,size,path) in acc])
+		for (mtime,size,path) in sorted(acc):
+			if total <= max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+		self.size = total
+
+	def clear(self):
+		self.evict(-1)
+
+def get_disk_size(stat):
+	# Allocated size of a file (its length where blocks are not reported)
+	if hasattr(stat,'st_blocks'):
+		return stat.st_blocks*512
+	return stat.st_size
+
+def cached_refinement(func):
+	# Memoize a create_fibril.refine_* method in fibril.cache (no caching when fibril.cache is None). The clash tests of the call (none on a hit)
+	# are kept in fibril.refine_evaluations, so that run statistics never enter the cache
+	@functools.wraps(func)
+	def wrapper(self,*args):
+		start = self.num_clash_evaluations
+		try:
+			return get_refinement(self,args)
+		finally:
+			self.refine_evaluations = self.num_clash_evaluations-start
+	def get_refinement(self,args):
+		if getattr(self,'cache',None) == None:
+			return func(self,*args)
+		key = self.cache.get_key(func.__name__,get_unit_hash(self.unit),self.get_refine_state(),args)
+		found,value = self.cache.get(key)
+		if found:
+			self.count('cache_hits')
+			return value
+		value = func(self,*args)
+		self.cache.set(key,value)
+		return value
+	return wrapper
@@ -0,0 +1,194 @@
+# Headless coordinate engine for builder.py (NumPy only, no PyMOL)
+
+import numpy as np
+
+# Template peptides of a 2 x 2 unit
+PEP_NAMES = ['s1_pep1','s1_pep2','s2_pep1','s2_pep2']
+# Outcomes of the cross-section test of neighbor stacks (get_edge_contact)
+EDGE_CONTACT = ['too_close','good_dist','too_far']
+# The 27 cells around (and including) a cell
+NEIGHBOR_CELLS = np.array([[i,j,k] for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)])
+# Atoms kept by the bead models of the clash tests (see create_fibril.resolution)
+RESOLUTION_ATOMS = {'backbone':['N','CA','C','O'],'ca':['CA']}
+
+class atom_template():
+	# INPUT (atom coordinates, atom names, residue names, residue numbers, chain IDs, element symbols)
+	def __init__(self,coords,name,resn,resi,chain,elem):
+		self.coords = np.array(coords,dtype=float).reshape((-1,3))
+		self.name = np.array(name,dtype=str)
+		self.resn = np.array(resn,dtype=str)
+		self.resi = np.array(resi,dtype=int)
+		self.chain = np.array(chain,dtype=str)
+		self.elem = np.array(elem,dtype=str)
+		self.ca = np.char.upper(self.name) == 'CA'
+		# Residue index of every atom (0, 1, ... in order of appearance)
+		self.residue = np.cumsum(np.r_[0,(self.resi[1:] != self.resi[:-1])|(self.chain[1:] != self.chain[:-1])])
+		# Bounding sphere
+		self.center = np.mean(self.coords,0)
+		self.bound = np.max(np.linalg.norm(self.coords-self.center,axis=1)) if len(self.coords) else 0.0
+		# Cell lists by cell size (see get_grid)
+		self.grids = {}
+
+	def __len__(self):
+		return len(self.coords)
+
+	def get_ca(self):
+		return self.coords[self.ca]
+
+	def take(self,idx):
+		# A template of the atoms idx, e.g. the bead model of a peptide
+		return atom_template(self.coords[idx],self.name[idx],self.resn[idx],self.resi[idx],self.chain[idx],self.elem[idx])
+
+	def get_beads(self,resolution):
+		# The atoms of RESOLUTION_ATOMS[resolution] (the CA mean, and so the y-centering of the copies, is unchanged)
+		return self.take(np.isin(np.char.upper(self.name),RESOLUTION_ATOMS[resolution]))
+
+	def get_grid(self,cell):
+		# Cell list of the template atoms, built once per cell size
+		if cell not in self.grids:
+			self.grids[cell] = contact_grid(self.coords,cell)
+		return self.grids[cell]
+
+class contact_grid():
+	# INPUT (reference coordinates, cell size)
+	def __init__(self,coords,cell):
+		self.coords = np.array(coords,dtype=float)
+		self.cell = float(cell)
+		key = np.floor(self.coords/self.cell).astype(int)
+		self.origin = key.min(0)
+		self.shape = key.max(0)-self.origin+1
+		lin = np.ravel_multi_index((key-self.origin).T,self.shape)
+		self.order = np.argsort(lin,kind='stable')
+		self.count = np.bincount(lin,minlength=int(np.prod(self.shape)))
+		self.start = np.cumsum(self.count)-self.count
+		# Bounding sphere for a quick rejection of far away copies
+		self.center = np.mean(self.coords,0)
+		self.bound = np.max(np.linalg.norm(self.coords-self.center,axis=1))
+		# Bounding box grown by one cell for a quick rejection of far away atoms
+		self.lower = np.min(self.coords,0)-self.cell
+		self.upper = np.max(self.coords,0)+self.cell
+
+	def get_min_distance(self,coords):
+		# Minimum distance between coords and the reference atoms (np.inf if no pair is within one cell)
+		coords = coords[np.all((coords >= self.lower)&(coords <= self.upper),axis=1)]
+		if len(coords) == 0:
+			return np.inf
+		key = np.floor(coords/self.cell).astype(int)-self.origin
+		key = key[:,None,:]+NEIGHBOR_CELLS[None,:,:]
+		inside = np.all((key >= 0)&(key < self.shape),axis=2)
+		idx_query = np.nonzero(inside)[0]
+		lin = np.ravel_multi_index(key[inside].T,self.shape)
+		count = self.count[lin]
+		total = np.sum(count)
+		if total == 0:
+			return np.inf
+		# Expand every (query atom, cell) pair into its candidate atoms
+		idx_ref = np.repeat(self.start[lin]-np.cumsum(count)+count,count)+np.arange(total)
+		dist = np.linalg.norm(coords[np.repeat(idx_query,count)]-self.coords[self.order[idx_ref]],axis=1)
+		min_dist = np.min(dist)
+		if min_dist < self.cell:
+			return min_dist
+		else:
+			return np.inf
+
+def get_pair_distance(grid_a,matrix_a,shift_a,template_b,matrix_b,shift_b):
+	# Minimum atom distance between two rigid copies, measured in the frame of copy a
+	center_a = np.dot(matrix_a,grid_a.center)+shift_a
+	center_b = np.dot(matrix_b,template_b.center)+shift_b
+	if np.linalg.norm(center_a-center_b) > grid_a.bound+template_b.bound+grid_a.cell:
+		return np.inf
+	coords_b = np.dot(np.dot(template_b.coords,matrix_b.T)+shift_b-shift_a,matrix_a)
+	return grid_a.get_min_distance(coords_b)
+
+def get_min_contact(templates,matrices,shifts,cell,pairs=None,stop=None):
+	# Minimum atom distance over pairs (a,b) of rigid copies, all pairs by default (np.inf beyond cell).
+	# With stop, the closest pairs are measured first and the first distance within stop is returned
+	if pairs is None:
+		pairs = [(a,b) for a in range(len(templates)) for b in range(a+1,len(templates))]
+	if len(pairs) == 0:
+		return np.inf
+	# Drop the pairs whose bounding spheres are more than cell apart
+	center = np.einsum('nij,nj->ni',np.array(matrices),np.array([t.center for t in templates]))+np.array(shifts)
+	bound = np.array([t.bound for t in templates])
+	idx_a,idx_b = np.array(pairs).T
+	gap = np.linalg.norm(center[idx_a]-center[idx_b],axis=1)-bound[idx_a]-bound[idx_b]
+	near = np.where(gap <= cell)[0]
+	if stop != None:
+		near = near[np.argsort(gap[near],kind='stable')]
+	min_dist = np.inf
+	for (a,b) in zip(idx_a[near].tolist(),idx_b[near].tolist()):
+		grid_a = templates[a].get_grid(cell)
+		min_dist = min(min_dist,get_pair_distance(grid_a,matrices[a],shifts[a],templates[b],matrices[b],shifts[b]))
+		if (stop != None) and (min_dist <= stop):
+			break
+	return min_dist
+
+def along_y(y):
+	return np.outer(y,[0,1,0])
+
+def rotation_matrices(angle_z,angle_y):
+	# Rotate about z first and then about y (angles in degree), as pymol.cmd.rotate does
+	theta_z = np.atleast_1d(np.array(angle_z,dtype=float))*np.pi/180
+	theta_y = np.atleast_1d(np.array(angle_y,dtype=float))*np.pi/180
+	theta_z,theta_y = np.broadcast_arrays(theta_z,theta_y)
+	cz,sz,cy,sy = np.cos(theta_z),np.sin(theta_z),np.cos(theta_y),np.sin(theta_y)
+	zero,one = np.zeros(theta_z.shape),np.ones(theta_z.shape)
+	matrix_z = np.stack([cz,-sz,zero,sz,cz,zero,zero,zero,one],axis=-1).reshape((-1,3,3))
+	matrix_y = np.stack([cy,zero,sy,zero,one,zero,-sy,zero,cy],axis=-1).reshape((-1,3,3))
+	return np.matmul(matrix_y,matrix_z)
+
+def get_rigid_transforms(template,angle_z,angle_y,translation1,translation2,center=1):
+	# Express every copy as x -> R.x+c (translation1, y-centering by CA, rotation, translation2)
+	matrix = rotation_matrices(angle_z,angle_y)
+	n = len(matrix)
+	translation1 = np.broadcast_to(np.array(translation1,dtype=float),(n,3))
+	translation2 = np.broadcast_to(np.array(translation2,dtype=float),(n,3))
+	center = np.broadcast_to(np.array(center,dtype=float),(n,))
+	y = np.mean(template.get_ca()[:,1])+translation1[:,1]
+	shift = translation1-np.outer(center*y,[0,1,0])
+	return matrix,np.einsum('nij,nj->ni',matrix,shift)+translation2
+
+def transform_points(points,angle_z,angle_y,translation1,translation2):
+	# Batched rigid transformation of a point set without y-centering (e.g. bounding boxes), (N_copies, N_points, 3)
+	matrix = rotation_matrices(angle_z,angle_y)
+	n = len(matrix)
+	translation1 = np.broadcast_to(np.array(translation1,dtype=float),(n,3))
+	translation2 = np.broadcast_to(np.array(translation2,dtype=float),(n,3))
+	points = np.array(points,dtype=float)[None,:,:]+translation1[:,None,:]
+	return np.einsum('nij,naj->nai',matrix,points)+translation2[:,None,:]
+
+def transform_copies(template,angle_z,angle_y,translation1,translation2,center=1):
+	# One batched rotation plus translation over (N_copies, N_atoms, 3)
+	matrix,shift = get_rigid_transforms(template,angle_z,angle_y,translation1,translation2,center)
+	return np.einsum('nij,aj->nai',matrix,template.coords)+shift[:,None,:]
+
+def get_twist(b,theta_z,radius):
+	# Twist angle (radian, nan where the tilted unit cannot span the radius) and rise per strand of a helix with a tilt angle theta_z
+	k = b*np.sin(theta_z)
+	with np.errstate(invalid='ignore',divide='ignore'):
+		theta_y = np.arccos(1-0.5*(k/radius)**2)
+	return theta_y,b*np.cos(theta_z)
+
+def get_edge_contact(l,radius,theta_z,theta_y,y,theta_stack,num_stack):
+	# Cross-section test of neighbor stacks of a stacked ribbon as an index into EDGE_CONTACT, over broadcast parameter arrays
+	radius,theta_z,theta_y,y,theta_stack,num_stack = np.broadcast_arrays(*[np.array(v,dtype=float) for v in [radius,theta_z,theta_y,y,theta_stack,num_stack]])
+	edge = (radius**2+(l*np.cos(theta_z)/2.0)**2)**0.5
+	with np.errstate(invalid='ignore',divide='ignore'):
+		theta_shift = 2*np.arcsin(l*np.cos(theta_z)/(2*edge))
+		y_shift = l*np.sin(theta_z)/2.0
+		# Only strands i with |y*i-2*y_shift| < 4 can come within 4 A of the edge of the next stack
+		num_strand = np.floor(2*np.pi/theta_y)
+		first = np.maximum(np.floor((2*y_shift-4)/y)-1,0)
+		last = np.minimum(np.ceil((2*y_shift+4)/y)+1,num_strand-1)
+	defined = np.isfinite(first)&np.isfinite(last)&np.isfinite(theta_y)
+	width = int(np.max((last-first)[defined]))+1 if np.any(defined) else 1
+	i = np.where(defined,first,0)[...,None]+np.arange(max(width,1))
+	pos_edge1 = np.stack([np.cos(theta_stack)*edge,y_shift,np.sin(theta_stack)*edge],axis=-1)[...,None,:]
+	angle = theta_shift[...,None]+theta_y[...,None]*i
+	pos_edge2 = np.stack([np.cos(angle)*edge[...,None],-y_shift[...,None]+y[...,None]*i,np.sin(angle)*edge[...,None]],axis=-1)
+	contact = np.where(i <= last[...,None],np.linalg.norm(pos_edge1-pos_edge2,axis=-1),np.inf)
+	min_contact = np.min(contact,axis=-1)
+	code = np.where(min_contact <= 1,0,np.where(min_contact < 4,1,2))
+	# Intersection on the cross-section (or no twist)
+	code[(theta_stack < theta_shift)|(num_stack*theta_stack > 2*np.pi)|~np.isfinite(theta_y)] = 0
+	return code
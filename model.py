@@ -0,0 +1,106 @@
+# Compact array-backed fibril model returned by the create_fibril builds (NumPy only, no PyMOL)
+
+import os
+import numpy as np
+from engine import PEP_NAMES,transform_copies
+from pdbio import get_format,write_structure
+
+# Rigid transformation of every copy in a copy table (see create_fibril.place)
+TRANSFORM_KEYS = ['angle_z','angle_y','translation1','translation2','center']
+
+class fibril_model():
+	# INPUT (template peptides by PEP_NAMES, copy table (pep, layer, stack, angle_z, ...) in output order, coordinates of every copy or None, refined dimension)
+	def __init__(self,templates,table,coords=None,dimension={}):
+		# The atom metadata stays with the four templates and is shared by all copies
+		self.templates = templates
+		self.pep = np.array(table['pep'],dtype=np.int32)
+		self.layer = np.array(table['layer'],dtype=np.int32)
+		self.stack = np.array(table['stack'],dtype=np.int32)
+		self.sheet = self.pep//2
+		self.dimension = dict(dimension)
+		size = np.array([len(templates[pep]) for pep in PEP_NAMES])[self.pep]
+		self.start = np.r_[0,np.cumsum(size)]
+		# Without coordinates the transforms are kept, and the coordinates are computed on the first get_coords
+		self.transforms = dict([(key,np.array(table[key])) for key in TRANSFORM_KEYS if key in table])
+		if coords is None:
+			self.coords = None
+		else:
+			if isinstance(coords,list):
+				coords = np.concatenate(coords) if len(coords) else np.zeros((0,3))
+			self.coords = np.asarray(coords,dtype=np.float32).reshape((-1,3))
+
+	def __len__(self):
+		return len(self.pep)
+
+	def get_chain(self):
+		# Chain index of every copy (two sheets per stack)
+		return 2*self.stack+self.sheet
+
+	def get_atom_index(self,idx):
+		# Rows of self.coords that belong to the copies idx, copy by copy
+		idx = np.asarray(idx,dtype=int)
+		size = self.start[idx+1]-self.start[idx]
+		return np.repeat(self.start[idx]-np.cumsum(size)+size,size)+np.arange(np.sum(size))
+
+	def get_coords(self,k=None):
+		# Coordinates of copy k, or of all atoms
+		if self.coords is None:
+			# One batched transformation per template peptide
+			self.coords = np.zeros((self.start[-1],3),dtype=np.float32)
+			for (p,pep) in enumerate(PEP_NAMES):
+				idx = np.where(self.pep == p)[0]
+				if len(idx):
+					lo_coord = transform_copies(self.templates[pep],*[self.transforms[key][idx] for key in TRANSFORM_KEYS])
+					self.coords[self.get_atom_index(idx)] = lo_coord.reshape((-1,3))
+		if k == None:
+			return self.coords
+		return self.coords[self.start[k]:self.start[k+1]]
+
+	def take(self,idx):
+		# A model of the copies idx (templates are shared)
+		idx = np.asarray(idx,dtype=int)
+		table = {'pep':self.pep[idx],'layer':self.layer[idx],'stack':self.stack[idx]}
+		table.update(dict([(key,value[idx]) for (key,value) in self.transforms.items()]))
+		coords = None if self.coords is None else self.coords[self.get_atom_index(idx)]
+		return fibril_model(self.templates,table,coords,self.dimension)
+
+	def select(self,sheet=None,layer=None,stack=None,pep=None):
+		# The copies in the given sheets (0, 1), layers (e.g. range(0,10)), stacks and template peptides (index or name)
+		mask = np.ones(len(self),dtype=bool)
+		for (values,key) in [(sheet,self.sheet),(layer,self.layer),(stack,self.stack),(pep,self.pep)]:
+			if values is None:
+				continue
+			if isinstance(values,(int,np.integer,str)):
+				values = [values]
+			values = [PEP_NAMES.index(v) if isinstance(v,str) else v for v in values]
+			mask &= np.isin(key,values)
+		return self.take(np.where(mask)[0])
+
+	def get_atoms(self,key):
+		# Per-atom values of a template field ('name', 'resn', 'resi', 'elem', 'ca', ...) expanded over all copies
+		field = [getattr(self.templates[pep],key) for pep in PEP_NAMES]
+		offset = np.r_[0,np.cumsum([len(f) for f in field])]
+		idx = np.repeat(offset[self.pep]-self.start[:-1],np.diff(self.start))+np.arange(self.start[-1])
+		return np.concatenate(field)[idx]
+
+	def iter_copies(self):
+		# Yield (template, coordinates, chain index, segment) one peptide copy at a time, as create_fibril.iter_copies
+		chain = self.get_chain()
+		for k in range(len(self)):
+			pep = PEP_NAMES[self.pep[k]]
+			yield self.templates[pep],self.get_coords(k).astype(float),chain[k],pep[:2].upper()
+
+	def get_size(self):
+		# Number of atoms, the largest number of residues in a chain, and number of chains
+		if len(self) == 0:
+			return 0,0,0
+		num_residues = np.array([self.templates[pep].residue[-1]+1 for pep in PEP_NAMES])
+		lo_residues = np.bincount(self.get_chain(),weights=num_residues[self.pep])
+		return int(self.start[-1]),int(np.max(lo_residues)),int(np.max(self.get_chain()))+1
+
+	def save(self,root_out):
+		# Write the model to PDB (or mmCIF beyond the PDB limits)
+		fmt = get_format(root_out,*self.get_size())
+		if (fmt == 'cif') and not root_out.lower().endswith(('.cif','.mmcif')):
+			root_out = os.path.splitext(root_out)[0]+'.cif'
+		return write_structure(root_out,self.iter_copies(),fmt,os.path.splitext(os.path.basename(root_out))[0])
@@ -0,0 +1,85 @@
+# Opt-in instrumentation of create_fibril: phase timers, counters and one record per build
+
+import contextlib
+import functools
+import time
+
+class build_monitor():
+	# INPUT (function called with the record of every finished build, print messages as well)
+	def __init__(self,callback=None,echo=1):
+		self.callback = callback
+		self.echo = echo
+		self.records = []
+		self.start()
+
+	def start(self):
+		# Forget the timers, counters and messages of the previous build
+		self.times = {}
+		self.counts = {}
+		self.messages = []
+		self.active = set()
+
+	@contextlib.contextmanager
+	def phase(self,name):
+		# Add the time spent in a phase (a phase entered again from inside itself is timed once)
+		if name in self.active:
+			yield
+			return
+		self.active.add(name)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.times[name] = self.times.get(name,0.0)+time.perf_counter()-start
+			self.active.discard(name)
+
+	def count(self,name,num=1):
+		self.counts[name] = self.counts.get(name,0)+num
+
+	def message(self,text):
+		self.messages += [text]
+		if self.echo:
+			print (text)
+
+	def finish(self,record={}):
+		# Close the current build: its record holds the given fields plus times, counts and messages
+		record = dict(record)
+		record.update({'times':dict(self.times),'counts':dict(self.counts),'messages':list(self.messages)})
+		self.records += [record]
+		if self.callback != None:
+			self.callback(record)
+		self.start()
+		return record
+
+def monitored_phase(name):
+	# Time a create_fibril method as a phase of fibril.monitor (a plain call when fibril.monitor is None)
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self,*args,**kwargs):
+			if getattr(self,'monitor',None) == None:
+				return func(self,*args,**kwargs)
+			with self.monitor.phase(name):
+				return func(self,*args,**kwargs)
+		return wrapper
+	return decorator
+
+def monitored_build(func):
+	# Record a create_fibril build_a_* (or extend) call in fibril.monitor: status, arguments and the refined dimension
+	@functools.wraps(func)
+	def wrapper(self,*args,**kwargs):
+		if getattr(self,'monitor',None) == None:
+			return func(self,*args,**kwargs)
+		layout,num_copies = self.layout,len(getattr(self,'copies',[]))
+		self.monitor.start()
+		with self.monitor.phase('build'):
+			value = func(self,*args,**kwargs)
+		# A build sets a new layout and an extension adds copies to it
+		accepted = (self.layout is not layout) or (len(getattr(self,'copies',[])) != num_copies)
+		record = {'build':func.__name__,'args':list(args),'kwargs':dict(kwargs),'status':'accept' if accepted else 'reject'}
+		if record['status'] == 'accept':
+			record['num_copies'] = len(self.table['pep'])
+			for key in ['radius','angle_z','angle_y','pitch','period']:
+				record[key] = float(getattr(self,key))
+		self.monitor.finish(record)
+		return value
+	return wrapper
@@ -0,0 +1,194 @@
+# Streaming PDB/mmCIF writer and PDB reader for builder.py
+
+import os
+import numpy as np
+
+# Limits of the PDB format
+PDB_MAX_ATOMS = 99999
+PDB_MAX_RESIDUES = 9999
+CHAIN_IDS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+# Two-letter elements whose symbol starts in column 13 of an atom name
+TWO_LETTER_ELEMENTS = ['BR','CA','CD','CL','CO','CU','FE','HG','MG','MN','NA','NI','SE','ZN']
+CIF_FIELDS = ['group_PDB','id','type_symbol','label_atom_id','label_alt_id','label_comp_id','label_asym_id','label_entity_id','label_seq_id',\
+				'pdbx_PDB_ins_code','Cartn_x','Cartn_y','Cartn_z','occupancy','B_iso_or_equiv','auth_seq_id','auth_asym_id','pdbx_PDB_model_num']
+
+def get_chain_id(idx):
+	# A, B, ..., 9 for the first 62 chains, then AA, AB, ... (mmCIF only)
+	if idx < len(CHAIN_IDS):
+		return CHAIN_IDS[idx]
+	idx = idx-len(CHAIN_IDS)+26
+	acc = ''
+	while idx >= 0:
+		acc = CHAIN_IDS[idx%26]+acc
+		idx = idx//26-1
+	return acc
+
+def get_format(root_out,num_atoms,num_residues,num_chains):
+	# mmCIF if asked for or if the structure does not fit in the PDB format
+	if os.path.splitext(root_out)[1].lower() in ['.cif','.mmcif']:
+		return 'cif'
+	if (num_atoms > PDB_MAX_ATOMS) or (num_residues > PDB_MAX_RESIDUES) or (num_chains > len(CHAIN_IDS)):
+		return 'cif'
+	return 'pdb'
+
+def pdb_lines(template,coords,atom_start,resi_start,chain,segi):
+	# Format one transformed copy as PDB ATOM records, residues renumbered from resi_start
+	acc = []
+	resi = template.residue+resi_start
+	for a in range(len(template)):
+		name = template.name[a]
+		name = name if len(name) == 4 else ' '+name
+		acc += ['ATOM  %5d %-4s %3s %1s%4d    %8.3f%8.3f%8.3f  1.00  0.00      %-4s%2s  '%(atom_start+a,name,template.resn[a],chain,resi[a],\
+					coords[a,0],coords[a,1],coords[a,2],segi,template.elem[a])]
+	return acc
+
+def cif_lines(template,coords,atom_start,resi_start,chain,model=1):
+	# Format one transformed copy as mmCIF atom_site rows, residues renumbered from resi_start
+	acc = []
+	resi = template.residue+resi_start
+	for a in range(len(template)):
+		name = template.name[a]
+		name = '"'+name+'"' if "'" in name else name
+		acc += ['ATOM %d %s %s . %s %s 1 %d ? %.3f %.3f %.3f 1.00 0.00 %d %s %d'%(atom_start+a,template.elem[a] or '?',name,template.resn[a],chain,resi[a],\
+					coords[a,0],coords[a,1],coords[a,2],resi[a],chain,model)]
+	return acc
+
+def iter_lines(records,fmt,name='fibril',state=None,header=1):
+	# Yield the text of one copy at a time from (template, coordinates, chain index, segment) records
+	# state ({'atom':next serial,'lo_resi':{chain:next residue},'chain':last chain}) is updated to continue numbering in a later call,
+	# whose lines (without header) can be appended in place of the END (or closing #) of the earlier ones
+	if (fmt == 'cif') and header:
+		yield '\n'.join(['data_'+name,'#','loop_']+['_atom_site.'+field for field in CIF_FIELDS])+'\n'
+	if state == None:
+		state = {'atom':1,'lo_resi':{}}
+	atom,lo_resi,last_chain = state['atom'],state['lo_resi'],state.get('chain')
+	for (template,coords,idx_chain,segi) in records:
+		chain = get_chain_id(idx_chain)
+		resi = lo_resi.get(chain,1)
+		if fmt == 'cif':
+			lines = cif_lines(template,coords,atom,resi,chain)
+		else:
+			lines = pdb_lines(template,coords,atom,resi,chain,segi)
+			if (last_chain != None) and (chain != last_chain):
+				lines = ['TER']+lines
+		yield '\n'.join(lines)+'\n'
+		atom += len(template)
+		lo_resi[chain] = resi+template.residue[-1]+1
+		last_chain = chain
+		state['atom'],state['chain'] = atom,chain
+	if fmt == 'cif':
+		yield '#\n'
+	else:
+		yield 'END\n'
+
+def write_structure(root_out,records,fmt,name='fibril'):
+	# Stream records to root_out without holding more than one copy in memory
+	with open(root_out,'w') as f:
+		for text in iter_lines(records,fmt,name):
+			f.write(text)
+	return root_out
+
+class frame_writer():
+	# INPUT (output file: .pdb for MODEL records, or .dcd for raw frames with the topology in a .pdb next to it, structure name)
+	def __init__(self,root_out,name='fibril'):
+		self.root_out = root_out
+		self.fmt = 'dcd' if root_out.lower().endswith('.dcd') else 'pdb'
+		self.name = name
+		self.num_frames = 0
+		self.num_atoms = None
+
+	def add(self,coords,records):
+		# Append one frame of coordinates (N_atoms, 3); the records (template, coordinates, chain index, segment) are only read for the first frame
+		coords = np.asarray(coords,dtype=float).reshape((-1,3))
+		if self.num_frames == 0:
+			self.start(coords,records)
+		elif len(coords) != self.num_atoms:
+			raise ValueError('Every frame must have '+str(self.num_atoms)+' atoms')
+		elif self.fmt == 'pdb':
+			xyz = np.char.mod('%8.3f',coords).astype(object).sum(1)
+			with open(self.root_out,'a') as f:
+				f.write('MODEL     %4d\n'%(self.num_frames+1)+''.join((self.prefix+xyz+self.suffix).tolist())+'ENDMDL\n')
+		else:
+			self.write_dcd_frame(coords)
+		self.num_frames += 1
+
+	def start(self,coords,records):
+		# Write the topology with the first frame
+		text = ''.join(iter_lines(records,'pdb',self.name))
+		lines = text.splitlines(True)[:-1]
+		self.num_atoms = len(coords)
+		atom = np.array([line.startswith('ATOM') for line in lines])
+		if np.sum(atom) != self.num_atoms:
+			raise ValueError('The records do not match the coordinates')
+		if self.fmt == 'pdb':
+			# The text around the coordinates of every line, TER records kept in front of the next atom
+			acc,pending = [],''
+			for line in lines:
+				if line.startswith('ATOM'):
+					acc += [(pending+line[:30],line[54:])]
+					pending = ''
+				else:
+					pending += line
+			self.prefix = np.array([p for (p,q) in acc],dtype=object)
+			self.suffix = np.array([q for (p,q) in acc],dtype=object)
+			with open(self.root_out,'w') as f:
+				f.write('MODEL     %4d\n'%1+''.join(lines)+'ENDMDL\n')
+		else:
+			with open(os.path.splitext(self.root_out)[0]+'.pdb','w') as f:
+				f.write(text)
+			# CHARMM/NAMD header: CORD, 20 control integers (frames, first step, step interval, steps, ..., version 24), title, atoms
+			icntrl = np.zeros(20,dtype='<i4')
+			icntrl[[1,2,19]] = [1,1,24]
+			title = ('Created by FibrilGen: '+self.name).ljust(80)[:80].encode()
+			with open(self.root_out,'wb') as f:
+				f.write(np.array([84],dtype='<i4').tobytes()+b'CORD'+icntrl.tobytes()+np.array([84],dtype='<i4').tobytes())
+				f.write(np.array([84,1],dtype='<i4').tobytes()+title+np.array([84],dtype='<i4').tobytes())
+				f.write(np.array([4,self.num_atoms,4],dtype='<i4').tobytes())
+			self.write_dcd_frame(coords)
+
+	def write_dcd_frame(self,coords):
+		size = np.array([4*self.num_atoms],dtype='<i4').tobytes()
+		with open(self.root_out,'r+b') as f:
+			f.seek(0,2)
+			for k in range(3):
+				f.write(size+np.ascontiguousarray(coords[:,k],dtype='<f4').tobytes()+size)
+			# Number of frames and of steps in the header
+			f.seek(8)
+			f.write(np.array([self.num_frames+1],dtype='<i4').tobytes())
+			f.seek(20)
+			f.write(np.array([self.num_frames+1],dtype='<i4').tobytes())
+
+def read_pdb(root):
+	# Read the ATOM/HETATM records of the first model into NumPy arrays (no PyMOL)
+	acc = []
+	with open(root) as f:
+		for line in f:
+			if line.startswith(('ATOM','HETATM')):
+				acc += [line.rstrip('\r\n').ljust(80)]
+			elif line.startswith('ENDMDL'):
+				break
+	name = [line[12:16].strip() for line in acc]
+	elem = [line[76:78].strip() or get_element(line[12:16]) for line in acc]
+	return {'coords':np.array([[float(line[30:38]),float(line[38:46]),float(line[46:54])] for line in acc]).reshape((-1,3)),\
+			'name':np.array(name,dtype=str),'resn':np.array([line[17:20].strip() for line in acc],dtype=str),\
+			'resi':np.array([int(line[22:26]) for line in acc],dtype=int),'chain':np.array([line[21].strip() for line in acc],dtype=str),\
+			'elem':np.array(elem,dtype=str)}
+
+def get_element(name):
+	# Element symbol from a 4-character PDB atom name when columns 77-78 are empty
+	if (name[0] not in ' 0123456789') and (name[:2].upper() in TWO_LETTER_ELEMENTS):
+		return name[:2].capitalize()
+	return name.strip().lstrip('0123456789')[:1].upper()
+
+def select_atoms(atoms,resi=None,name=None):
+	# Indices of atoms in residues resi ('21-30', '22', '1-5+8') and with an atom name in name ('CA', 'N+CA+C'), case-insensitive as in PyMOL
+	mask = np.ones(len(atoms['coords']),dtype=bool)
+	if resi != None:
+		keep = np.zeros(len(mask),dtype=bool)
+		for part in str(resi).split('+'):
+			first,sep,last = part.partition('-')
+			keep |= (atoms['resi'] >= int(first)) & (atoms['resi'] <= int(last if sep else first))
+		mask &= keep
+	if name != None:
+		mask &= np.isin(np.char.upper(atoms['name']),[n.upper() for n in name.split('+')])
+	return np.where(mask)[0]
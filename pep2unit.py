@@ -4,6 +4,9 @@ import numpy as np
 import pymol
 import math
 
+# Atoms kept in place by rotate_sidechain
+BACKBONE_NAMES = ['CA','N','H','C','O','H1','H2','H3','OXT']
+
 def get_ca(name):
 	pymol.cmd.select('lo_ca','name ca and '+name)
 	pos_ca = pymol.cmd.get_coords('lo_ca',1)
@@ -70,29 +73,34 @@ class create_pep_unit():
 		return [unit_x,unit_y,unit_z]
 
 	def rotate_sidechain(self,ax,rot,idx):
-		def rotate_atom(ax,idx,theta,ori):
-			init_pos = np.array(pymol.cmd.get_coords('index '+idx,1))-ori_i
-			c,s = np.cos(theta),np.sin(theta)
-			if ax == 'x':
-				m = np.array([[1,0,0],[0,c,-s],[0,s,c]])
-			elif ax == 'y':
-				m = np.array([[c,0,s],[0,1,0],[-s,0,c]])
-			else:
-				m = np.array([[c,-s,0],[s,c,0],[0,0,1]])
-			final_pos = np.dot(m,init_pos.T).T
-			pymol.cmd.translate((final_pos-init_pos)[0].tolist(),'index '+idx)
-
-		# rotate around axis ax
-		for i in idx:
-			resi_i,rot_i = str(i+1),rot[i]
-			# get origin
-			ori_i = get_ca('resi '+resi_i)	
-			# get side chain idx
-			lo_idx = pymol.cmd.index('resi '+resi_i+' and not name CA+N+H+C+O+H1+H2+H3+OXT')
-			# rotate side chain
-			for idx in lo_idx:
-				rotate_atom(ax,str(idx[1]),rot_i*np.pi/180,ori_i)
-			self.set_boundary()
+		# rotate side chains of residues idx (0-based) around axis ax through their CA by rot (degree), all at once
+		acc = []
+		pymol.cmd.iterate(self.name,'acc.append((resv,name.upper()))',space={'acc':acc})
+		coords = pymol.cmd.get_coords(self.name,1)
+		resv = np.array([a[0] for a in acc])
+		name = np.array([a[1] for a in acc])
+		lo_resv = np.array(idx)+1
+		theta = np.zeros(max(resv.max(),lo_resv.max())+1)
+		theta[lo_resv] = np.array(rot)[np.array(idx)]*np.pi/180
+		# get origin (CA) of every selected residue
+		is_ca = (name == 'CA')&np.isin(resv,lo_resv)
+		ori = np.zeros((len(theta),3))
+		ori[resv[is_ca]] = coords[is_ca]
+		# get side chain atoms
+		side = np.isin(resv,lo_resv[np.isin(lo_resv,resv[is_ca])])&~np.isin(name,BACKBONE_NAMES)
+		c,s = np.cos(theta[resv[side]]),np.sin(theta[resv[side]])
+		zero,one = np.zeros(len(c)),np.ones(len(c))
+		if ax == 'x':
+			m = np.stack([one,zero,zero,zero,c,-s,zero,s,c],axis=-1)
+		elif ax == 'y':
+			m = np.stack([c,zero,s,zero,one,zero,-s,zero,c],axis=-1)
+		else:
+			m = np.stack([c,-s,zero,s,c,zero,zero,zero,one],axis=-1)
+		# rotate side chains
+		init_pos = coords[side]-ori[resv[side]]
+		coords[side] = ori[resv[side]]+np.einsum('nij,nj->ni',m.reshape((-1,3,3)),init_pos)
+		pymol.cmd.load_coords(coords,self.name,state=1)
+		self.set_boundary()
 
 	def set_boundary(self):
 		# Set dimensions
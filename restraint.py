@@ -0,0 +1,68 @@
+# Amber NMR restraints (nmropt=1) between central CA atoms of consecutive beta-strands
+
+import numpy as np
+from engine import PEP_NAMES
+
+def get_layout(lo_range,space,offset_head,offset_tail):
+	# Strand layout from per-sheet values: strand ranges of every sheet, atoms per strand, and the 0-based offsets of the two central atoms
+	num_strand = np.array([r[1]-r[0] for r in lo_range])
+	idx_sheet = np.repeat(np.arange(len(lo_range)),num_strand)
+	idx_strand = np.concatenate([np.arange(r[1]-r[0]) for r in lo_range])
+	def expand(values):
+		# Cycle the values of each sheet over its strands
+		return np.array([v[i%len(v)] for (v,i) in zip([values[j] for j in idx_sheet],idx_strand)],dtype=int)
+	atoms = expand(space)
+	atom_start = np.cumsum(atoms)-atoms
+	return atom_start,expand(offset_head),expand(offset_tail),idx_sheet
+
+def get_fibril_layout(fibril):
+	# Strand layout of the last build of a create_fibril object, in the order written by create_fibril.save
+	table = fibril.table
+	templates = [fibril.unit.templates[pep] for pep in PEP_NAMES]
+	atoms = np.array([len(t) for t in templates])[table['pep']]
+	# The two central CA atoms of every template peptide; in pep2 the head is the one facing the head of pep1
+	head,tail = [],[]
+	for (i,t) in enumerate(templates):
+		ca = np.where(t.ca)[0]
+		lo_central = [ca[(len(ca)-1)//2],ca[len(ca)//2+(len(ca)%2) if len(ca) > 1 else 0]]
+		if i%2 == 1:
+			d = [np.linalg.norm(t.coords[k]-templates[i-1].coords[head[-1]]) for k in lo_central]
+			lo_central = lo_central[::int(np.sign(d[1]-d[0]) or 1)]
+		head += [lo_central[0]]
+		tail += [lo_central[1]]
+	head = np.array(head)[table['pep']]
+	tail = np.array(tail)[table['pep']]
+	atom_start = np.cumsum(atoms)-atoms
+	return atom_start,head,tail,2*table['stack']+table['pep']//2
+
+def get_pairs(atom_start,head,tail,idx_sheet):
+	# 1-based atom numbers of head-head and tail-tail pairs of consecutive strands in the same sheet
+	same = idx_sheet[1:] == idx_sheet[:-1]
+	head_atom = atom_start+head+1
+	tail_atom = atom_start+tail+1
+	return np.stack([head_atom[:-1][same],head_atom[1:][same],tail_atom[:-1][same],tail_atom[1:][same]],axis=1)
+
+def format_stage(pairs,nstep,k_step,k_step_split,bounds,k_init):
+	# All &rst lines of one stage: a constant force constant, then the varying force constants
+	b1,b2,b3,b4 = [str(b) for b in bounds]
+	c_step0,c_step1 = nstep[0],nstep[1]
+	fixed = ', r1='+b1+', r2='+b2+', r3='+b3+', r4='+b4+', rk2='+str(k_init)+', rk3='+str(k_init)+', nstep1='+str(c_step0)+', nstep2='+str(c_step1)+', &end/ \n'
+	lo_vari = [', nstep1='+str(ks[0])+', nstep2='+str(ks[1])+', ifvari=1, r1a='+b1+', r2a='+b2+', r3a='+b3+', r4a='+b4+', rk2a='+str(k)+', rk3a='+str(k)+', &end/ \n' \
+				for (k,ks) in zip(k_step,k_step_split)]
+	iat_head = np.array(['&rst iat='+str(i)+','+str(j) for (i,j) in pairs[:,:2].tolist()],dtype=object)
+	iat_tail = np.array(['&rst iat='+str(i)+','+str(j) for (i,j) in pairs[:,2:].tolist()],dtype=object)
+	columns = [iat_head+fixed,iat_tail+fixed]
+	for vari in lo_vari:
+		columns += [iat_head+vari,iat_tail+vari]
+	return ''.join(np.stack(columns,axis=1).reshape(-1).tolist())
+
+def write_restraints(pairs,stages,bounds=(0.0,2.0,9.0,11.0),k_init=10.):
+	# Write every stage, a dict of root_out, nstep ([step0,step1,step2,step3]) and optionally k_step and k_step_split, with one write per file
+	for stage in stages:
+		nstep = stage['nstep']
+		k_step = stage.get('k_step',[k_init])
+		k_step_split = stage.get('k_step_split',[[nstep[2],nstep[3]]])
+		text = format_stage(pairs,nstep,k_step,k_step_split,bounds,k_init)
+		with open(stage['root_out'],'w') as f:
+			f.write(text)
+	return [stage['root_out'] for stage in stages]
@@ -0,0 +1,449 @@
+# python service.py -h
+
+import argparse
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+# Builds a job can run, and the create_fibril settings it can change
+BUILD_METHODS = ['build_a_flat_sheet','build_a_stacked_sheet','build_a_rod','build_a_stacked_rod','build_a_ribbon','build_a_stacked_ribbon']
+SERVICE_SETTINGS = ['tilt_s1','tilt_s2','dist_tolorence','contact_reach','twist_limit','twist_tolorence','refine_iterations']
+# Result files of every job type and output
+RESULT_TYPES = {'pdb':'chemical/x-pdb','cif':'chemical/x-mmcif','npz':'application/octet-stream','csv':'text/csv'}
+# Units kept by the service and by every worker
+MAX_UNITS = 64
+
+def get_unit_key(pdb_text,peptides,points):
+	# Content address of a unit: the input structure and the selection of the four peptides and three reference atoms
+	h = hashlib.sha256()
+	h.update(pdb_text.encode())
+	h.update(json.dumps([list(peptides),list(points)]).encode())
+	return h.hexdigest()[:16]
+
+def init_service_worker(root_units,events):
+	# Import the builder once per worker, so that jobs start warm
+	global worker_units,worker_root,worker_events
+	import builder
+	import sweep
+	worker_units = collections.OrderedDict()
+	worker_root,worker_events = root_units,events
+
+def get_worker_unit(key):
+	# The worker reads a unit once from the files of the service and keeps it (and the cell lists of its templates) between jobs
+	if key not in worker_units:
+		with open(os.path.join(worker_root,key+'.pkl'),'rb') as f:
+			worker_units[key] = pickle.load(f)
+		while len(worker_units) > MAX_UNITS:
+			worker_units.popitem(last=False)
+	worker_units.move_to_end(key)
+	return worker_units[key]
+
+def get_fibril(unit,settings,root_cache):
+	import builder
+	fibril = builder.create_fibril(unit)
+	fibril.mode = 'none'
+	for (key,value) in settings.items():
+		setattr(fibril,key,value)
+	if root_cache != None:
+		fibril.cache = builder.refine_cache(root_cache)
+	fibril.monitor = builder.build_monitor(echo=0)
+	return fibril
+
+def run_job(job_id,job,key,root_results,root_cache):
+	# Run one job in a worker process and write its result file to root_results, returning a summary of the result
+	worker_events.put((job_id,'running'))
+	start = time.perf_counter()
+	try:
+		unit = get_worker_unit(key)
+		if job['type'] == 'build':
+			result = run_build(job_id,job,unit,root_results,root_cache)
+		elif job['type'] == 'library':
+			result = run_library(job_id,job,unit,root_results,root_cache)
+		else:
+			result = run_sweep_job(job_id,job,unit,root_results,root_cache)
+	except Exception:
+		result = {'state':'failed','error':traceback.format_exc()}
+	result['time'] = time.perf_counter()-start
+	result['pid'] = os.getpid()
+	return result
+
+def run_build(job_id,job,unit,root_results,root_cache):
+	# One build, written as PDB (mmCIF beyond the PDB limits) or as an archive of one model
+	from archive import save_archive
+	fibril = get_fibril(unit,job.get('settings',{}),root_cache)
+	model = getattr(fibril,job['method'])(*job.get('args',[]))
+	record = fibril.monitor.records[-1]
+	result = {'state':'done','status':record['status'],'messages':record['messages'],'times':record['times'],'counts':record['counts']}
+	if model == None:
+		return result
+	result['dimension'] = model.dimension
+	result['num_copies'],result['num_atoms'] = len(model),model.get_size()[0]
+	if job.get('output','pdb') == 'npz':
+		root_out = save_archive(os.path.join(root_results,job_id+'.npz'),model,[{'method':job['method'],'args':job.get('args',[])}])
+	else:
+		root_out = model.save(os.path.join(root_results,job_id+'.pdb'))
+	result['file'] = os.path.basename(root_out)
+	return result
+
+def run_library(job_id,job,unit,root_results,root_cache):
+	# Builds of one method over a list of arguments, e.g. candidates of a screen, with the accepted models in one archive
+	from archive import save_archive
+	fibril = get_fibril(unit,job.get('settings',{}),root_cache)
+	models,info,lo_status = [],[],[]
+	for args in job['lo_args']:
+		model = getattr(fibril,job['method'])(*args)
+		lo_status += [fibril.monitor.records[-1]['status']]
+		if model != None:
+			models += [model]
+			info += [{'method':job['method'],'args':args}]
+	result = {'state':'done','status':lo_status,'num_models':len(models)}
+	if len(models):
+		result['file'] = os.path.basename(save_archive(os.path.join(root_results,job_id+'.npz'),models,info))
+	return result
+
+def run_sweep_job(job_id,job,unit,root_results,root_cache):
+	# A sweep of sweep.py in this worker, written as its CSV table
+	import sweep
+	ranges = dict([(key,job[key]) for key in ['angle_z','radius','angle_stack','num_stack','sign'] if key in job])
+	if job.get('random',0):
+		points = sweep.get_random(job['random'],job.get('seed',0),**ranges)
+	else:
+		points = sweep.get_grid(**ranges)
+	options = dict(job.get('settings',{}))
+	if root_cache != None:
+		options['cache'] = sweep.refine_cache(root_cache)
+	root_out = os.path.join(root_results,job_id+'.csv')
+	rows = sweep.run_sweep(unit,job['morphology'],points,root_out,job.get('stacking',[[1]]),1,options,not job.get('fixed',0))
+	return {'state':'done','num_points':len(rows),'num_accepted':len([row for row in rows if row['status'] == 'accept']),'file':os.path.basename(root_out)}
+
+class build_service():
+	# INPUT (number of worker processes, directory of the result files, directory of the refinement cache, directory of the structures
+	# that units can name by path instead of sending them)
+	def __init__(self,num_workers=None,root_results=None,root_cache=None,root_inputs=None):
+		self.root_results = root_results or tempfile.mkdtemp(prefix='fibrilgen_')
+		os.makedirs(self.root_results,exist_ok=True)
+		self.root_cache = root_cache
+		self.root_inputs = root_inputs
+		# Units are written once for the workers, so that a job only names its unit
+		self.root_units = tempfile.mkdtemp(prefix='fibrilgen_units_')
+		self.num_workers = num_workers or os.cpu_count()
+		self.units = collections.OrderedDict()
+		self.jobs = {}
+		self.ids = itertools.count(1)
+		self.lock = threading.Lock()
+		# One warm pool shared by all clients; the workers report the jobs they start
+		ctx = multiprocessing.get_context('spawn')
+		self.events = ctx.Queue()
+		self.pool = ctx.Pool(self.num_workers,init_service_worker,(self.root_units,self.events))
+		self.listener = threading.Thread(target=self.listen,daemon=True)
+		self.listener.start()
+
+	def listen(self):
+		# Mark jobs as running when a worker picks them up (their result may have arrived first)
+		while True:
+			event = self.events.get()
+			if event == None:
+				return
+			job_id,state = event
+			with self.lock:
+				if (job_id in self.jobs) and (self.jobs[job_id]['state'] == 'queued'):
+					self.jobs[job_id]['state'] = state
+
+	def get_input_path(self,root_pdb):
+		# A structure named by path must lie in root_inputs
+		if self.root_inputs == None:
+			raise ValueError('Structures are only read by path with --inputs; send pdb_text instead')
+		root = os.path.realpath(self.root_inputs)
+		path = os.path.realpath(os.path.join(root,root_pdb))
+		if os.path.commonpath([root,path]) != root:
+			raise ValueError('Structure outside the input directory: '+str(root_pdb))
+		return path
+
+	def add_unit(self,spec):
+		# Read a unit ({'pdb_text' or 'pdb': path in root_inputs, 'peptides', 'points'}) once per structure and selection, returning its key
+		if 'pdb_text' in spec:
+			pdb_text = spec['pdb_text']
+		else:
+			with open(self.get_input_path(spec['pdb'])) as f:
+				pdb_text = f.read()
+		key = get_unit_key(pdb_text,spec['peptides'],spec['points'])
+		with self.lock:
+			if key in self.units:
+				self.units.move_to_end(key)
+				return key
+		import builder
+		import sweep
+		with tempfile.NamedTemporaryFile('w',suffix='.pdb',delete=False) as f:
+			f.write(pdb_text)
+		try:
+			state = sweep.unit_state(builder.read_sheet_unit(f.name,spec['peptides'],spec['points']))
+		finally:
+			os.remove(f.name)
+		root_unit = os.path.join(self.root_units,key+'.pkl')
+		with open(root_unit+'.tmp','wb') as f:
+			pickle.dump(state,f)
+		os.replace(root_unit+'.tmp',root_unit)
+		with self.lock:
+			self.units[key] = state
+			while len(self.units) > MAX_UNITS:
+				old = self.units.popitem(last=False)[0]
+				os.remove(os.path.join(self.root_units,old+'.pkl'))
+		return key
+
+	def get_unit_info(self,key):
+		state = self.units[key]
+		return {'unit':key,'d':float(state.d),'b1':float(state.b1),'b2':float(state.b2),'l':float(state.l),\
+				'num_atoms':sum([len(t) for t in state.templates.values()])}
+
+	def submit(self,job):
+		# Queue a job ({'type': 'build', 'library' or 'sweep', 'unit': key or unit spec, ...}), returning its id
+		job = dict(job)
+		job.setdefault('type','build')
+		if job['type'] not in ['build','library','sweep']:
+			raise ValueError('Unknown job type: '+str(job['type']))
+		if (job['type'] in ['build','library']) and (job.get('method') not in BUILD_METHODS):
+			raise ValueError('Unknown build: '+str(job.get('method')))
+		for key in job.get('settings',{}):
+			if key not in SERVICE_SETTINGS:
+				raise ValueError('Unknown setting: '+str(key))
+		key = job['unit'] if isinstance(job['unit'],str) else self.add_unit(job['unit'])
+		with self.lock:
+			if key not in self.units:
+				raise KeyError('Unknown unit: '+str(key))
+			self.units.move_to_end(key)
+			job['unit'] = key
+			job_id = 'job'+str(next(self.ids))
+			self.jobs[job_id] = {'id':job_id,'type':job['type'],'unit':key,'state':'queued','submitted':time.time()}
+		def finish(result):
+			with self.lock:
+				self.jobs[job_id].update(result)
+		def fail(error):
+			with self.lock:
+				self.jobs[job_id].update({'state':'failed','error':repr(error)})
+		self.pool.apply_async(run_job,(job_id,job,key,self.root_results,self.root_cache),callback=finish,error_callback=fail)
+		return job_id
+
+	def get_job(self,job_id):
+		with self.lock:
+			return dict(self.jobs[job_id])
+
+	def get_result_path(self,job_id):
+		job = self.get_job(job_id)
+		if 'file' not in job:
+			return None
+		return os.path.join(self.root_results,job['file'])
+
+	def remove_job(self,job_id):
+		# Forget a finished job and delete its result file
+		path = self.get_result_path(job_id)
+		with self.lock:
+			if self.jobs[job_id]['state'] in ['queued','running']:
+				raise ValueError('Job '+job_id+' is still '+self.jobs[job_id]['state'])
+			del self.jobs[job_id]
+		if (path != None) and os.path.exists(path):
+			os.remove(path)
+
+	def get_status(self):
+		with self.lock:
+			count = collections.Counter([job['state'] for job in self.jobs.values()])
+			return {'workers':self.num_workers,'units':len(self.units),'jobs':dict(count),'results':self.root_results}
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+		self.events.put(None)
+		self.listener.join()
+		for name in os.listdir(self.root_units):
+			os.remove(os.path.join(self.root_units,name))
+		os.rmdir(self.root_units)
+
+class service_handler(http.server.BaseHTTPRequestHandler):
+	# JSON requests: POST /units, POST /jobs, GET /jobs/<id>, GET /jobs/<id>/result, DELETE /jobs/<id>, GET /status
+	def send_json(self,value,code=200):
+		data = json.dumps(value).encode()
+		self.send_response(code)
+		self.send_header('Content-Type','application/json')
+		self.send_header('Content-Length',str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def read_json(self):
+		size = int(self.headers.get('Content-Length',0))
+		return json.loads(self.rfile.read(size).decode() or '{}')
+
+	def handle_request(self,func):
+		# Client errors are answered with their message
+		try:
+			func()
+		except KeyError as error:
+			self.send_json({'error':str(error.args[0]) if error.args else str(error)},404)
+		except (ValueError,TypeError,OSError) as error:
+			self.send_json({'error':str(error)},400)
+
+	def do_POST(self):
+		service = self.server.service
+		path = self.path.strip('/').split('/')
+		def post():
+			if path == ['units']:
+				self.send_json(service.get_unit_info(service.add_unit(self.read_json())))
+			elif path == ['jobs']:
+				self.send_json(service.get_job(service.submit(self.read_json())),202)
+			else:
+				raise KeyError(self.path)
+		self.handle_request(post)
+
+	def do_GET(self):
+		service = self.server.service
+		path = self.path.strip('/').split('/')
+		def get():
+			if path == ['status']:
+				self.send_json(service.get_status())
+			elif (len(path) == 2) and (path[0] == 'jobs'):
+				self.send_json(service.get_job(path[1]))
+			elif (len(path) == 3) and (path[0] == 'jobs') and (path[2] == 'result'):
+				root = service.get_result_path(path[1])
+				if root == None:
+					raise KeyError('No result for '+path[1])
+				with open(root,'rb') as f:
+					data = f.read()
+				self.send_response(200)
+				self.send_header('Content-Type',RESULT_TYPES.get(os.path.splitext(root)[1][1:],'application/octet-stream'))
+				self.send_header('Content-Disposition','attachment; filename="'+os.path.basename(root)+'"')
+				self.send_header('Content-Length',str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+			else:
+				raise KeyError(self.path)
+		self.handle_request(get)
+
+	def do_DELETE(self):
+		service = self.server.service
+		path = self.path.strip('/').split('/')
+		def delete():
+			if (len(path) == 2) and (path[0] == 'jobs'):
+				service.remove_job(path[1])
+				self.send_json({'id':path[1],'state':'removed'})
+			else:
+				raise KeyError(self.path)
+		self.handle_request(delete)
+
+	def log_message(self,format,*args):
+		if self.server.verbose:
+			http.server.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+def serve(host='127.0.0.1',port=8765,num_workers=None,root_results=None,root_cache=None,root_inputs=None,verbose=0):
+	# Run the service until interrupted
+	service = build_service(num_workers,root_results,root_cache,root_inputs)
+	server = http.server.ThreadingHTTPServer((host,port),service_handler)
+	server.service,server.verbose = service,verbose
+	print ('FibrilGen service on http://'+host+':'+str(server.server_address[1])+' with '+str(service.num_workers)+' workers, results in '+service.root_results)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.close()
+
+class build_client():
+	# INPUT (address of a running service); a thin client, e.g. in PyMOL: submit, wait, then load the result
+	def __init__(self,url='http://127.0.0.1:8765'):
+		self.url = url.rstrip('/')
+
+	def request(self,method,path,value=None):
+		data = None if value == None else json.dumps(value).encode()
+		req = urllib.request.Request(self.url+path,data,{'Content-Type':'application/json'},method=method)
+		try:
+			with urllib.request.urlopen(req) as response:
+				return response.read()
+		except urllib.error.HTTPError as error:
+			raise RuntimeError(json.loads(error.read().decode()).get('error',str(error)))
+
+	def add_unit(self,root_pdb,peptides,points):
+		# Send a bilayer and its selection (e.g. ['21-30','31-40','111-120','121-130'], ['22/CA','29/CA','62/CA']), returning the unit key
+		with open(root_pdb) as f:
+			spec = {'pdb_text':f.read(),'peptides':list(peptides),'points':list(points)}
+		return json.loads(self.request('POST','/units',spec))['unit']
+
+	def submit(self,job):
+		return json.loads(self.request('POST','/jobs',job))['id']
+
+	def build(self,unit,method,args,output='pdb',settings={}):
+		# e.g. build(unit,'build_a_stacked_ribbon',[10,30,70,2,20,1]); output 'pdb' or 'npz'
+		return self.submit({'type':'build','unit':unit,'method':method,'args':list(args),'output':output,'settings':dict(settings)})
+
+	def library(self,unit,method,lo_args,settings={}):
+		return self.submit({'type':'library','unit':unit,'method':method,'lo_args':[list(args) for args in lo_args],'settings':dict(settings)})
+
+	def sweep(self,unit,morphology,settings={},**ranges):
+		# e.g. sweep(unit,'s_ribbon',angle_z=[5,10],radius=[20,30],angle_stack=[70],num_stack=[2],sign=[1])
+		job = {'type':'sweep','unit':unit,'morphology':morphology,'settings':dict(settings)}
+		job.update(ranges)
+		return self.submit(job)
+
+	def get_job(self,job_id):
+		return json.loads(self.request('GET','/jobs/'+job_id))
+
+	def get_status(self):
+		return json.loads(self.request('GET','/status'))
+
+	def wait(self,job_id,interval=0.5,timeout=None):
+		# Poll until the job is done or failed
+		start = time.time()
+		while True:
+			job = self.get_job(job_id)
+			if job['state'] not in ['queued','running']:
+				return job
+			if (timeout != None) and (time.time()-start > timeout):
+				return job
+			time.sleep(interval)
+
+	def fetch(self,job_id,root_out=None):
+		# Download the result file of a finished job
+		job = self.get_job(job_id)
+		if 'file' not in job:
+			raise RuntimeError('No result for '+job_id+' ('+job['state']+')')
+		root_out = root_out or job['file']
+		with open(root_out,'wb') as f:
+			f.write(self.request('GET','/jobs/'+job_id+'/result'))
+		return root_out
+
+	def load(self,job_id,name=None,root_out=None):
+		# Download a structure and load it into PyMOL (archives are opened with archive.open_archive instead)
+		from pymol import cmd
+		root_out = self.fetch(job_id,root_out or os.path.join(tempfile.gettempdir(),job_id+'_'+self.get_job(job_id)['file']))
+		if root_out.endswith('.npz'):
+			from archive import open_archive
+			return open_archive(root_out)
+		name = name or job_id
+		cmd.load(root_out,name)
+		return name
+
+	def remove(self,job_id):
+		return json.loads(self.request('DELETE','/jobs/'+job_id))
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Serve fibril builds and sweeps to local clients from a shared pool of worker processes.')
+	parser.add_argument('--host',default='127.0.0.1')
+	parser.add_argument('--port',type=int,default=8765)
+	parser.add_argument('--workers',type=int,default=None,help='number of worker processes (default: all CPUs)')
+	parser.add_argument('--results',default=None,help='directory of the result files (default: a new temporary directory)')
+	parser.add_argument('--cache',default=None,help='directory of the refinement cache shared by the workers')
+	parser.add_argument('--inputs',default=None,help='directory of the structures that units can name by path (default: units send their PDB text)')
+	parser.add_argument('--verbose',action='store_true',help='log every request')
+	args = parser.parse_args(argv)
+	serve(args.host,args.port,args.workers,args.results,args.cache,args.inputs,args.verbose)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,257 @@
+# python sweep.py -h
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import numpy as np
+from cache import refine_cache
+from engine import EDGE_CONTACT,get_edge_contact,get_twist
+from monitor import build_monitor
+
+# Morphologies that can be refined, and the parameters each of them takes
+SWEEP_MORPHOLOGY = {'a_rod':['angle_z','sign'],\
+					's_rod':['angle_z','sign'],\
+					'a_ribbon':['angle_z','radius','sign'],\
+					's_ribbon':['angle_z','radius','angle_stack','num_stack','sign']}
+SWEEP_COLUMNS = ['idx','morphology','angle_z','radius','angle_stack','num_stack','sign',\
+					'status','refined_angle_z','refined_angle_y','refined_radius','pitch','period']
+# Columns added when the workers have a monitor (options['monitor'])
+SWEEP_PROFILE_COLUMNS = ['time_refine','time_clash','clash_evaluations','iterations','cache_hits']
+
+class unit_state():
+	# A copy of the create_sheet_unit geometry that can be sent to worker processes
+	def __init__(self,unit):
+		for key in ['d','b1','b2','b','l','box_boundaries','box_w','box_l','templates']:
+			setattr(self,key,getattr(unit,key))
+
+def get_grid(angle_z,radius=[0],angle_stack=[0],num_stack=[1],sign=[1]):
+	# Every combination of the listed values
+	return [dict(zip(['angle_z','radius','angle_stack','num_stack','sign'],point)) \
+				for point in itertools.product(angle_z,radius,angle_stack,num_stack,sign)]
+
+def get_random(num,seed,angle_z,radius=[0],angle_stack=[0],num_stack=[1],sign=[1]):
+	# Uniform samples within [min,max] of the continuous parameters, random choices of the discrete ones
+	rng = np.random.default_rng(seed)
+	acc = []
+	for i in range(num):
+		acc += [{'angle_z':rng.uniform(min(angle_z),max(angle_z)),\
+				'radius':rng.uniform(min(radius),max(radius)),\
+				'angle_stack':rng.uniform(min(angle_stack),max(angle_stack)),\
+				'num_stack':int(rng.choice(num_stack)),\
+				'sign':int(rng.choice(sign))}]
+	return acc
+
+def refine_point(fibril,morphology,point,stacking=None):
+	# Refine one set of input parameters, returning the refined geometry (None if rejected)
+	theta_z,sign = point['angle_z']*np.pi/180,point['sign']
+	if morphology == 'a_rod':
+		radius = fibril.unit.d/2.0
+		param = fibril.refine_theta(theta_z,radius,sign)
+		if param != None:
+			theta_z,theta_y,y = param
+	elif morphology == 's_rod':
+		pos_matrix = fibril.get_position_matrix(stacking,point['angle_z'])
+		radius_matrix = (pos_matrix[:,:,0]**2+pos_matrix[:,:,1]**2)**0.5
+		radius = max(radius_matrix.reshape(-1))
+		lo_position = pos_matrix.reshape((-1,2))[np.array(stacking).reshape(-1) != 0].tolist()
+		param = fibril.refine_stack_rod(theta_z,radius_matrix.reshape(-1),sign,lo_position)
+		if param != None:
+			theta_z,theta_y,y = param
+	elif morphology == 'a_ribbon':
+		param = fibril.refine_theta_radius(theta_z,point['radius'],sign)
+		if param != None:
+			theta_z,theta_y,radius,y = param
+	elif morphology == 's_ribbon':
+		param = fibril.refine_stack_ribbon(theta_z,point['radius'],sign,point['angle_stack']*np.pi/180,point['num_stack'])
+		if param != None:
+			theta_z,theta_y,radius,y = param[:4]
+	else:
+		raise ValueError('Unknown morphology: '+str(morphology))
+	if param == None:
+		return None
+	fibril.set_dimension(radius,theta_z,theta_y,y)
+	return {'refined_angle_z':fibril.angle_z,'refined_angle_y':fibril.angle_y,'refined_radius':fibril.radius,\
+			'pitch':fibril.pitch,'period':fibril.period}
+
+def check_point(fibril,morphology,point,stacking=None):
+	# Check one set of parameters as given, without refinement, returning its geometry (None if clashed)
+	theta_z,sign = point['angle_z']*np.pi/180,point['sign']
+	d = fibril.unit.d
+	if morphology == 'a_rod':
+		radius = d/2.0
+		theta_y,y = get_twist(fibril.unit.b,theta_z,radius)
+		good_unit = fibril.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[np.sign(-d/2.0)*sign,np.sign(d/2.0)*sign],sign,0)
+	elif morphology == 's_rod':
+		pos_matrix = fibril.get_position_matrix(stacking,point['angle_z'])
+		lo_radius = ((pos_matrix[:,:,0]**2+pos_matrix[:,:,1]**2)**0.5).reshape(-1)
+		theta_y,y = get_twist(fibril.unit.b,theta_z,min(lo_radius))
+		good_unit = 1
+		for a_radius in fibril.get_unique_radii(lo_radius):
+			good_unit = fibril.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[np.sign(-d/2.0)*sign,np.sign(d/2.0)*sign],sign,a_radius)
+			if not good_unit:
+				break
+		if good_unit:
+			lo_position = pos_matrix.reshape((-1,2))[np.array(stacking).reshape(-1) != 0].tolist()
+			good_unit *= fibril.units_are_not_clashed(theta_z*180/np.pi,theta_y*180/np.pi,sign,lo_position)
+		radius = max(lo_radius)
+	elif morphology in ['a_ribbon','s_ribbon']:
+		radius = point['radius']
+		theta_y,y = get_twist(fibril.unit.b,theta_z,radius)
+		if morphology == 'a_ribbon':
+			good_unit = fibril.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[sign,sign],sign,radius)
+		else:
+			theta_stack = point['angle_stack']*np.pi/180
+			good_unit = EDGE_CONTACT[int(get_edge_contact(fibril.unit.l,radius-d/2.0,theta_z,theta_y,y,theta_stack,point['num_stack']))] == 'good_dist'
+			if good_unit:
+				good_unit = fibril.check_unit(theta_z*180/np.pi,theta_y*180/np.pi,[sign,sign],sign,radius,point['angle_stack'])
+	else:
+		raise ValueError('Unknown morphology: '+str(morphology))
+	if not good_unit:
+		return None
+	fibril.set_dimension(radius,theta_z,theta_y,y)
+	return {'refined_angle_z':fibril.angle_z,'refined_angle_y':fibril.angle_y,'refined_radius':fibril.radius,\
+			'pitch':fibril.pitch,'period':fibril.period}
+
+def prefilter(unit,morphology,points,stacking=None,refine=1,twist_limit=8.0):
+	# Analytic feasibility of all points at once: '' for the points that go on to the atom-level checks, else the reason of the rejection.
+	# With refinement only the constraints that refinement cannot change are used (the stacks of a stacked ribbon overlapping)
+	def values(key,default=0):
+		return np.array([point.get(key,default) for point in points],dtype=float)
+	theta_z,radius = values('angle_z')*np.pi/180,values('radius')
+	theta_stack,num_stack = values('angle_stack')*np.pi/180,values('num_stack',1)
+	status = np.full(len(points),'',dtype=object)
+	if morphology == 's_ribbon':
+		status[num_stack*theta_stack > 2*np.pi] = 'reject_stack'
+	if refine:
+		return status.tolist()
+	if morphology == 'a_rod':
+		radius = np.full(len(points),unit.d/2.0)
+	elif morphology == 's_rod':
+		# The innermost unit sets the twist
+		stack_z,stack_x = np.array(stacking).shape
+		dist_x = unit.box_l*np.cos(theta_z)+unit.b*np.sin(theta_z)
+		pos_z = ((stack_z-1)/2.0-np.arange(stack_z))*unit.box_w
+		pos_x = (-(stack_x-1)/2.0+np.arange(stack_x))[None,:]*dist_x[:,None]
+		radius = np.min((pos_z[None,:,None]**2+pos_x[:,None,:]**2)**0.5,axis=(1,2))
+	theta_y,y = get_twist(unit.b,theta_z,radius)
+	status[(status == '')&~(theta_y*180/np.pi < twist_limit)] = 'reject_twist'
+	if morphology == 's_ribbon':
+		code = get_edge_contact(unit.l,radius-unit.d/2.0,theta_z,theta_y,y,theta_stack,num_stack)
+		status[(status == '')&(code != EDGE_CONTACT.index('good_dist'))] = 'reject_edge'
+	return status.tolist()
+
+def init_worker(state,options):
+	# Every worker holds its own fibril object (no PyMOL state is shared)
+	global worker_fibril
+	import builder
+	worker_fibril = builder.create_fibril(state)
+	worker_fibril.mode = 'none'
+	for (key,value) in options.items():
+		setattr(worker_fibril,key,value)
+
+def run_worker(job):
+	idx,morphology,point,stacking,refine = job
+	row = dict([(key,point.get(key,'')) for key in ['angle_z','radius','angle_stack','num_stack','sign']])
+	row['idx'],row['morphology'] = idx,morphology
+	monitor = worker_fibril.monitor
+	if monitor != None:
+		monitor.start()
+	if refine:
+		refined = refine_point(worker_fibril,morphology,point,stacking)
+	else:
+		# A point as given is its own final pose, so with verify it is checked with all atoms only
+		with worker_fibril.at_resolution(['atom',worker_fibril.resolution][not worker_fibril.verify]):
+			refined = check_point(worker_fibril,morphology,point,stacking)
+	if refined == None:
+		row['status'] = 'reject'
+	else:
+		row['status'] = 'accept'
+		row.update(refined)
+	if monitor != None:
+		row.update(get_profile(monitor.finish({'idx':idx,'morphology':morphology,'status':row['status']})))
+	return row
+
+def get_profile(record):
+	# The SWEEP_PROFILE_COLUMNS of a monitor record
+	times,counts = record['times'],record['counts']
+	return {'time_refine':times.get('refine',0.0),'time_clash':times.get('clash',0.0),\
+			'clash_evaluations':counts.get('clash_evaluations',0),'iterations':counts.get('iterations',0),'cache_hits':counts.get('cache_hits',0)}
+
+def run_sweep(unit,morphology,points,root_out,stacking=None,num_workers=None,options={},refine=1):
+	# Refine (or only check, if not refine) every point that passes the analytic prefilter on a process pool, and stream the results table to root_out
+	if morphology not in SWEEP_MORPHOLOGY:
+		raise ValueError('Unknown morphology: '+str(morphology))
+	state = unit_state(unit)
+	lo_status = prefilter(unit,morphology,points,stacking,refine,options.get('twist_limit',8.0))
+	jobs = [(idx,morphology,point,stacking,refine) for (idx,point) in enumerate(points) if lo_status[idx] == '']
+	acc = []
+	with open(root_out,'w',newline='') as f:
+		writer = csv.DictWriter(f,fieldnames=SWEEP_COLUMNS+(SWEEP_PROFILE_COLUMNS if options.get('monitor') != None else []),restval='')
+		writer.writeheader()
+		# Points rejected by the prefilter never reach a worker
+		for (idx,point) in enumerate(points):
+			if lo_status[idx] != '':
+				row = dict([(key,point.get(key,'')) for key in ['angle_z','radius','angle_stack','num_stack','sign']])
+				row.update({'idx':idx,'morphology':morphology,'status':lo_status[idx]})
+				writer.writerow(row)
+				acc += [row]
+		f.flush()
+		if num_workers == 1:
+			init_worker(state,options)
+			rows = map(run_worker,jobs)
+			for row in rows:
+				writer.writerow(row)
+				f.flush()
+				acc += [row]
+		elif len(jobs):
+			with multiprocessing.get_context('spawn').Pool(num_workers,init_worker,(state,options)) as pool:
+				for row in pool.imap_unordered(run_worker,jobs):
+					writer.writerow(row)
+					f.flush()
+					acc += [row]
+	return sorted(acc,key=lambda row:row['idx'])
+
+def load_unit(root_pdb,peptides,points):
+	# Create a sheet unit from four residue ranges and three (resi/name) reference atoms, without PyMOL
+	import builder
+	return builder.read_sheet_unit(root_pdb,peptides,points)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Refine a grid or a random sample of fibril parameters for one sheet unit.')
+	parser.add_argument('pdb',help='bilayer structure, e.g. structures/input/capF8_bilayer.pdb')
+	parser.add_argument('--peptides',nargs=4,required=True,help='residue ranges of the four peptides, e.g. 21-30 31-40 111-120 121-130')
+	parser.add_argument('--points',nargs=3,required=True,help='reference atoms as resi/name, e.g. 22/CA 29/CA 62/CA')
+	parser.add_argument('--morphology',required=True,choices=sorted(SWEEP_MORPHOLOGY))
+	parser.add_argument('--angle-z',nargs='+',type=float,required=True,help='tilt angles (degree)')
+	parser.add_argument('--radius',nargs='+',type=float,default=[0],help='radii (A)')
+	parser.add_argument('--angle-stack',nargs='+',type=float,default=[0],help='stacking angles (degree)')
+	parser.add_argument('--num-stack',nargs='+',type=int,default=[1],help='stacking numbers')
+	parser.add_argument('--sign',nargs='+',type=int,default=[1],choices=[-1,1],help='twist signs')
+	parser.add_argument('--stacking',nargs='+',default=['1'],help='rows of the stacking matrix, e.g. 0,1 1,1')
+	parser.add_argument('--random',type=int,default=0,help='number of random samples instead of a grid')
+	parser.add_argument('--seed',type=int,default=0)
+	parser.add_argument('--workers',type=int,default=None,help='number of worker processes (default: all CPUs)')
+	parser.add_argument('--out',default='sweep.csv')
+	parser.add_argument('--cache',default=None,help='directory of the refinement cache')
+	parser.add_argument('--fixed',action='store_true',help='check the parameters as given instead of refining them')
+	parser.add_argument('--profile',action='store_true',help='add refinement and clash times and counters of every point to the table')
+	args = parser.parse_args(argv)
+
+	ranges = {'angle_z':args.angle_z,'radius':args.radius,'angle_stack':args.angle_stack,'num_stack':args.num_stack,'sign':args.sign}
+	if args.random:
+		points = get_random(args.random,args.seed,**ranges)
+	else:
+		points = get_grid(**ranges)
+	stacking = [[int(k) for k in row.split(',')] for row in args.stacking]
+	unit = load_unit(args.pdb,args.peptides,args.points)
+	options = {}
+	if args.cache:
+		options['cache'] = refine_cache(args.cache)
+	if args.profile:
+		options['monitor'] = build_monitor(echo=0)
+	rows = run_sweep(unit,args.morphology,points,args.out,stacking,args.workers,options,not args.fixed)
+	print (str(len([row for row in rows if row['status'] == 'accept']))+' of '+str(len(rows))+' accepted, written to '+args.out)
+
+if __name__ == '__main__':
+	main()
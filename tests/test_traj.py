@@ -0,0 +1,32 @@
+# Reading Amber ASCII trajectories with and without box lines (python -m pytest tests)
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from analysis.traj import open_trajectory
+
+def write_mdcrd(root,coords,box):
+	# Title line, then 10 values of 8 characters per line, and a box line after every frame
+	with open(root,'w') as f:
+		f.write('test trajectory\n')
+		for frame in coords:
+			values = frame.reshape(-1)
+			for i in range(0,len(values),10):
+				f.write(''.join(['%8.3f' % v for v in values[i:i+10]])+'\n')
+			if box:
+				f.write(''.join(['%8.3f' % v for v in [30.0,40.0,50.0]])+'\n')
+
+@pytest.mark.parametrize('num_atoms',[1,21])
+@pytest.mark.parametrize('num_frames',[4,5])
+@pytest.mark.parametrize('box',[0,1])
+def test_mdcrd_box(tmp_path,num_atoms,num_frames,box):
+	coords = np.round(np.random.RandomState(num_atoms).uniform(-20,20,(num_frames,num_atoms,3)),3)
+	root = str(tmp_path/'traj.mdcrd')
+	write_mdcrd(root,coords,box)
+	traj = open_trajectory(root,num_atoms,chunk=3)
+	assert traj.box == box
+	frames = np.concatenate(list(traj.iter_blocks(np.arange(num_atoms))))
+	assert np.allclose(frames,coords)